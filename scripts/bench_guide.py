@@ -0,0 +1,436 @@
+import argparse
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from io import StringIO
+from pathlib import Path
+import build_first_use_docx
+import build_guide
+import convert_first_use_pdf
+from guide_ir import Guide
+
+
+HERE = Path(__file__).resolve().parent
+
+
+def scaled_guide(copies, numbered=True):
+    text = build_first_use_docx.SRC.read_text(encoding='utf-8')
+    head, body = text.split('\n## ', 1)
+    return head + ''.join(f'\n## {i + 1}.{body}' if numbered else f'\n## {body}' for i in range(copies))
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    with redirect_stdout(StringIO()):
+        fn(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def bench_ir(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        src = tmp / 'guide.md'
+        src.write_text(scaled_guide(args.copies), encoding='utf-8')
+        docx, pdf = tmp / 'guide.docx', tmp / 'guide.pdf'
+
+        def via_docx():
+            build_first_use_docx.build(src, docx, cache_dir=tmp / 'cache-a', force=True)
+            convert_first_use_pdf.build(docx, pdf, force=True)
+
+        def single_parse():
+            build_guide.build(src, docx, pdf, force=True, cache_dir=tmp / 'cache-b')
+
+        before = min(timed(via_docx) for _ in range(args.repeat))
+        after = min(timed(single_parse) for _ in range(args.repeat))
+    print(f'sections={args.copies * 4} docx round trip={before:.3f}s single parse={after:.3f}s saved={before - after:.3f}s ({(1 - after / before) * 100:.0f}%)')
+
+
+PEAK_RSS = '''
+import sys, time
+import convert_first_use_pdf
+start = time.perf_counter()
+convert_first_use_pdf.build(sys.argv[1], sys.argv[2], stream=sys.argv[3] == '1')
+# VmHWM, unlike ru_maxrss, is not inherited from the parent across exec.
+hwm = next(line for line in open('/proc/self/status') if line.startswith('VmHWM'))
+print(time.perf_counter() - start, hwm.split()[1])
+'''
+
+
+def bench_stream(args):
+    # Identical sections hit the DOCX section cache, so building the large
+    # inputs stays cheap; each conversion runs in a fresh process so its peak
+    # RSS is measured on its own.
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        for pages in args.pages:
+            src, docx = tmp / f'{pages}.md', tmp / f'{pages}.docx'
+            src.write_text(scaled_guide(pages, numbered=False), encoding='utf-8')
+            timed(build_first_use_docx.build, src, docx, cache_dir=tmp / 'cache')
+            row = [f'pages~{pages}']
+            for label, stream in (('docx', '0'), ('stream', '1')):
+                out = subprocess.run([sys.executable, '-c', PEAK_RSS, str(docx), str(tmp / 'out.pdf'), stream],
+                                     cwd=HERE, check=True, capture_output=True, text=True).stdout.split()
+                row.append(f'{label}: {float(out[-2]):.2f}s {int(out[-1]) // 1024}MB')
+            print('  '.join(row))
+
+
+WRITER = '''
+import sys, time
+from docx import Document
+import build_first_use_docx, docx_stream
+import guide_ir as ir
+
+def steps(count):
+    for i in range(count):
+        if i % 50 == 0:
+            yield ir.Heading(1, f'{i // 50 + 1}. 录制步骤')
+        yield ir.NumberItem(f'步骤 {i + 1}：点击“保存配置”，确认页面提示“保存成功”后继续下一步。', i % 50 + 1)
+        if i % 500 == 499:
+            yield ir.Note('请勿在录制中输入密码、验证码或访问令牌。')
+
+count, out = int(sys.argv[1]), sys.argv[2]
+start = time.perf_counter()
+if sys.argv[3] == 'stream':
+    docx_stream.write_docx(steps(count), out, '录制步骤')
+else:
+    doc = Document()
+    build_first_use_docx.setup(doc)
+    for block in steps(count):
+        build_first_use_docx.emit(doc, block)
+    doc.save(out)
+hwm = next(line for line in open('/proc/self/status') if line.startswith('VmHWM'))
+print(time.perf_counter() - start, hwm.split()[1])
+'''
+
+
+def bench_writer(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        for count in args.steps:
+            row = [f'steps={count}']
+            for mode in ('python-docx', 'stream'):
+                if mode == 'python-docx' and count > args.baseline_max:
+                    continue
+                out = subprocess.run([sys.executable, '-c', WRITER, str(count), str(Path(tmp) / 'out.docx'), mode],
+                                     cwd=HERE, check=True, capture_output=True, text=True).stdout.split()
+                seconds = float(out[-2])
+                row.append(f'{mode}: {seconds:.2f}s ({seconds / count * 1e6:.0f}us/step) {int(out[-1]) // 1024}MB')
+            print('  '.join(row))
+
+
+def legacy_table(doc, rows, widths, size=10.5):
+    # add_table as it was before bulk emission: per-cell tcMar, shading and
+    # set_font through python-docx proxies.
+    from docx.enum.table import WD_CELL_VERTICAL_ALIGNMENT
+    from docx.oxml import OxmlElement
+    from docx.oxml.ns import qn
+    table = doc.add_table(rows=1, cols=len(widths))
+    for values in rows[1:]:
+        table.add_row()
+    build_first_use_docx.set_table_layout(table, widths)
+    for row in table.rows:
+        for cell, width in zip(row.cells, widths):
+            build_first_use_docx.set_cell_width(cell, width)
+            cell.vertical_alignment = WD_CELL_VERTICAL_ALIGNMENT.CENTER
+            margins = OxmlElement('w:tcMar')
+            for side in ('top', 'start', 'bottom', 'end'):
+                node = OxmlElement(f'w:{side}')
+                node.set(qn('w:w'), '80' if side in ('top', 'bottom') else '120')
+                node.set(qn('w:type'), 'dxa')
+                margins.append(node)
+            cell._tc.get_or_add_tcPr().append(margins)
+    for row_i, (row, values) in enumerate(zip(table.rows, rows)):
+        for cell, text in zip(row.cells, values):
+            if row_i == 0:
+                build_first_use_docx.set_cell_shading(cell, build_first_use_docx.HEADER_FILL)
+            r = cell.paragraphs[0].add_run(text)
+            if row_i == 0:
+                build_first_use_docx.set_font(r, bold=True, color=build_first_use_docx.DARK_BLUE)
+            else:
+                build_first_use_docx.set_font(r, size=size)
+    return table
+
+
+def bench_table(args):
+    from docx import Document
+    widths = [2700, 2500, 4160]
+    for count in args.rows:
+        rows = [['服务', 'API 格式', '推荐模型']] + [[f'服务 {i}', 'OpenAI-compatible', f'model-{i}'] for i in range(count)]
+        row = [f'rows={count}']
+        for label, fn in (('per-cell', legacy_table), ('bulk', build_first_use_docx.add_table)):
+            doc = Document()
+            seconds = timed(fn, doc, rows, widths)
+            row.append(f'{label}: {seconds:.3f}s')
+        print('  '.join(row))
+
+
+def bench_parallel(args):
+    import os
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        src = tmp / 'guide.md'
+        src.write_text(scaled_guide(args.copies), encoding='utf-8')
+        serial = timed(convert_first_use_pdf.build, src, tmp / 'serial.pdf', section_breaks=True)
+        size = (tmp / 'serial.pdf').stat().st_size
+        print(f'sections={args.copies * 4} cpus={os.cpu_count()} serial={serial:.2f}s {size} bytes')
+        for workers in args.workers:
+            seconds = timed(convert_first_use_pdf.build_parallel, src, tmp / 'parallel.pdf', workers=workers, force=True)
+            print(f'  workers={workers} {seconds:.2f}s speedup={serial / seconds:.2f}x {(tmp / "parallel.pdf").stat().st_size} bytes')
+
+
+FONT_STARTUP = '''
+import time
+import convert_first_use_pdf
+start = time.perf_counter()
+convert_first_use_pdf.register_font()
+print(time.perf_counter() - start)
+'''
+
+
+def bench_font(args):
+    import shutil
+    import pdf_fonts
+    shutil.rmtree(pdf_fonts.CACHE_DIR, ignore_errors=True)
+    for label in ['cold'] + ['warm'] * args.repeat:
+        out = subprocess.run([sys.executable, '-c', FONT_STARTUP], cwd=HERE, check=True, capture_output=True, text=True).stdout
+        print(f'{label}: register_font {float(out.split()[-1]) * 1000:.1f}ms')
+
+
+def bench_long_table(args):
+    from guide_ir import Heading, Table
+    convert_first_use_pdf.register_font()
+    threshold = convert_first_use_pdf.LONG_TABLE_ROWS
+    with tempfile.TemporaryDirectory() as tmp:
+        for count in args.rows:
+            rows = [['步骤', '操作', '选择器']] + [[str(i + 1), f'点击“保存配置”按钮（第 {i + 1} 步）', f'#settings form > button.save-{i}'] for i in range(count)]
+            guide = Guide([Heading(1, '录制步骤'), Table(rows, [1200, 4560, 3600])])
+            row = [f'rows={count}']
+            for label, limit in (('single table', 10 ** 9), ('chunked', threshold)):
+                if limit > threshold and count > args.baseline_max:
+                    continue
+                convert_first_use_pdf.LONG_TABLE_ROWS = limit
+                seconds = timed(convert_first_use_pdf.build, out=Path(tmp) / 'table.pdf', guide=guide, force=True)
+                row.append(f'{label}: {seconds:.2f}s ({seconds / count * 1e3:.2f}ms/row)')
+            convert_first_use_pdf.LONG_TABLE_ROWS = threshold
+            print('  '.join(row))
+
+
+def screenshots(folder, count, repeat):
+    # A recorder session: every distinct screen is captured `repeat` times in
+    # a row, as happens when steps do not change the page. Each capture is
+    # encoded afresh, so only the pixels match.
+    import random
+    from PIL import Image, ImageDraw
+    names = []
+    for i in range(count):
+        rng = random.Random(i)
+        img = Image.new('RGB', (2560, 1600), 'white')
+        draw = ImageDraw.Draw(img)
+        for _ in range(60):
+            x, y = rng.randrange(2400), rng.randrange(1500)
+            draw.rectangle([x, y, x + rng.randrange(20, 400), y + rng.randrange(20, 200)], fill=tuple(rng.randrange(256) for _ in range(3)))
+        for j in range(repeat):
+            name = f'step-{i}-{j}.png'
+            img.save(folder / name, compress_level=j % 10)
+            names.append(name)
+    return names
+
+
+def bench_images(args):
+    import shutil
+    import guide_images
+    from guide_ir import Heading, Image, NumberItem
+    from guide_markdown import Section
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        names = screenshots(tmp, args.screens, args.repeat)
+        blocks = [Heading(1, '录制步骤')]
+        for i, name in enumerate(names):
+            blocks += [NumberItem(f'第 {i + 1} 步', i + 1), Image(name)]
+        raw = [Section('', [Image(str(tmp / b.path), b.alt, guide_images.PRINT_WIDTH, guide_images.PRINT_WIDTH * 10 / 16) if isinstance(b, Image) else b for b in blocks])]
+        cache = tmp / 'cache'
+        with redirect_stdout(StringIO()):
+            start = time.perf_counter()
+            prepared = guide_images.prepare_sections([Section('', blocks)], tmp, cache_dir=cache)
+            cold = time.perf_counter() - start
+            start = time.perf_counter()
+            guide_images.prepare_sections([Section('', blocks)], tmp, cache_dir=cache)
+            warm = time.perf_counter() - start
+        kept = sum(isinstance(b, Image) for b in prepared[0].blocks)
+        print(f'screenshots={len(names)} kept={kept} prepare cold={cold:.2f}s warm={warm:.2f}s')
+        for label, sections in (('original', raw), ('prepared', prepared)):
+            docx, pdf = tmp / f'{label}.docx', tmp / f'{label}.pdf'
+            docx_seconds = timed(build_guide.build_first_use_docx.build, tmp / 'guide.md', docx, cache_dir=tmp / f'{label}-sections', sections=sections, force=True)
+            guide = Guide([block for section in sections for block in section.blocks])
+            pdf_seconds = timed(convert_first_use_pdf.build, out=pdf, guide=guide, force=True)
+            print(f'{label}: docx {docx_seconds:.2f}s {docx.stat().st_size / 1e6:.1f}MB  pdf {pdf_seconds:.2f}s {pdf.stat().st_size / 1e6:.1f}MB')
+        shutil.rmtree(cache)
+
+
+def bench_layout_cache(args):
+    import dataclasses
+    import pdf_layout
+    from guide_ir import Bullet, NumberItem, Text
+    from reportlab import rl_config
+    rl_config.invariant = 1
+    convert_first_use_pdf.register_font()
+    base = convert_first_use_pdf.load_guide(build_first_use_docx.SRC).blocks
+    # Every copy gets its own text so a cold cache only hits on re-wraps.
+    guide = Guide([
+        dataclasses.replace(block, text=f'{block.text}（第 {i + 1} 份）') if isinstance(block, (Text, Bullet, NumberItem)) else block
+        for i in range(args.copies) for block in base
+    ])
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        pdf_layout.CACHE_DIR = tmp / 'layout'
+        outputs = {}
+        for label, cached in (('no cache', False), ('cold cache', True), ('warm cache', True)):
+            out = tmp / 'guide.pdf'
+            output = StringIO()
+            start = time.perf_counter()
+            with redirect_stdout(output):
+                convert_first_use_pdf.build(out=out, guide=guide, layout_cache=cached, force=True)
+            seconds = time.perf_counter() - start
+            outputs[label] = out.read_bytes()
+            summary = output.getvalue().strip().partition(' (')[2].rstrip(')')
+            print(f'{label}: {seconds:.2f}s  {summary}'.rstrip())
+    print('identical output:', outputs['no cache'] == outputs['warm cache'])
+
+
+def bench_fingerprint(args):
+    # Time to decide that both outputs are current versus rewriting them.
+    import guide_fingerprint
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        src = tmp / 'guide.md'
+        src.write_text(scaled_guide(args.copies), encoding='utf-8')
+        docx, pdf = tmp / 'guide.docx', tmp / 'guide.pdf'
+        rebuild = min(timed(build_guide.build, src, docx, pdf, force=True, cache_dir=tmp / 'cache') for _ in range(args.repeat))
+        check = min(timed(build_guide.build, src, docx, pdf, cache_dir=tmp / 'cache') for _ in range(args.repeat))
+        guide = guide_fingerprint.load_blocks(src)
+        docx_check = min(timed(guide_fingerprint.docx_entries, docx) for _ in range(args.repeat))
+        pdf_check = min(timed(guide_fingerprint.pdf_entries, pdf, guide.blocks) for _ in range(args.repeat))
+    print(f'sections={args.copies * 4} rebuild={rebuild:.3f}s up-to-date build={check:.3f}s '
+          f'(docx fingerprint {docx_check * 1000:.0f}ms, pdf fingerprint {pdf_check * 1000:.0f}ms)')
+
+
+RUNS = '''
+import sys, time
+import convert_first_use_pdf, docx_stream
+from guide_ir import Guide
+from pdf_layout import CachedParagraph
+src, out, rich = sys.argv[1], sys.argv[2], sys.argv[3] == '1'
+if not rich:
+    # Every paragraph flattened to its text and parsed as markup, as before
+    # run formatting was converted.
+    convert_first_use_pdf.rich_paragraph = lambda block, styles, name, **kwargs: CachedParagraph(
+        convert_first_use_pdf.markup(block.text), styles[name], **kwargs)
+convert_first_use_pdf.register_font()
+styles = convert_first_use_pdf.make_styles()
+start = time.perf_counter()
+blocks = list(docx_stream.iter_blocks(src, runs=rich))
+convert_first_use_pdf.build(out=out, guide=Guide(blocks), styles=styles, layout_cache=False, force=True)
+seconds = time.perf_counter() - start
+hwm = next(line for line in open('/proc/self/status') if line.startswith('VmHWM'))
+formatted = sum(bool(getattr(block, 'runs', ()) or getattr(block, 'bold_prefix', None)) for block in blocks)
+derived = sum(isinstance(key, tuple) and key[0] != 'fragments' for key in styles)
+print(seconds, hwm.split()[1], formatted, derived, len(convert_first_use_pdf.RUN_TAGS))
+'''
+
+
+def bench_runs(args):
+    # A DOCX where every step starts with a bold run, and the guide itself
+    # (almost no run formatting), each converted with run formatting and as
+    # flattened plain text in a fresh process so peak RSS is its own.
+    import guide_ir as ir
+    from docx_stream import write_docx
+
+    def steps(count):
+        for i in range(count):
+            if i % 50 == 0:
+                yield ir.Heading(1, f'{i // 50 + 1}. 录制步骤')
+            prefix = f'步骤 {i + 1}：'
+            yield ir.Text(f'{prefix}点击“保存配置”，确认页面提示“保存成功”后继续下一步。', prefix)
+            if i % 10 == 9:
+                yield ir.Code('npm run build\n  --out dist')
+            if i % 100 == 99:
+                yield ir.Note('请勿在录制中输入密码、验证码或访问令牌。')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        inputs = []
+        for count in args.steps:
+            inputs.append((f'steps={count}', tmp / f'steps-{count}.docx'))
+            write_docx(steps(count), inputs[-1][1], '录制步骤')
+        src = tmp / 'guide.md'
+        src.write_text(scaled_guide(args.copies), encoding='utf-8')
+        inputs.append((f'guide x{args.copies}', tmp / 'guide.docx'))
+        timed(build_first_use_docx.build, src, inputs[-1][1], cache_dir=tmp / 'cache')
+        for label, docx in inputs:
+            # The modes take turns so drift in machine load hits both alike.
+            best = {}
+            for _ in range(args.repeat):
+                for rich in '01':
+                    out = subprocess.run([sys.executable, '-c', RUNS, str(docx), str(tmp / 'out.pdf'), rich],
+                                         cwd=HERE, check=True, capture_output=True, text=True).stdout.split()
+                    if rich not in best or float(out[-5]) < float(best[rich][-5]):
+                        best[rich] = out
+            row = [label]
+            for mode, rich in (('plain', '0'), ('runs', '1')):
+                seconds, rss, formatted, styles, tags = float(best[rich][-5]), int(best[rich][-4]), *map(int, best[rich][-3:])
+                row.append(f'{mode}: {seconds:.2f}s {rss // 1024}MB')
+            row.append(f'formatted paragraphs={formatted} derived styles={styles} markup tags={tags}')
+            print('  '.join(row))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the guide build scripts.')
+    sub = parser.add_subparsers(dest='bench', required=True)
+    p = sub.add_parser('ir', help='DOCX round trip vs. single-parse IR for DOCX + PDF')
+    p.add_argument('--copies', type=int, default=50)
+    p.add_argument('--repeat', type=int, default=3)
+    p.set_defaults(run=bench_ir)
+    p = sub.add_parser('stream', help='peak RSS of the python-docx reader vs. the streaming reader')
+    p.add_argument('--pages', type=int, nargs='+', default=[10, 100, 1000, 10000])
+    p.set_defaults(run=bench_stream)
+    p = sub.add_parser('writer', help='python-docx object tree vs. streaming DOCX writer')
+    p.add_argument('--steps', type=int, nargs='+', default=[1000, 10000, 100000])
+    p.add_argument('--baseline-max', type=int, default=10000)
+    p.set_defaults(run=bench_writer)
+    p = sub.add_parser('table', help='per-cell table construction vs. cloned row templates')
+    p.add_argument('--rows', type=int, nargs='+', default=[100, 1000, 10000])
+    p.set_defaults(run=bench_table)
+    p = sub.add_parser('parallel', help='serial layout vs. process-pool layout split at Heading 1')
+    p.add_argument('--copies', type=int, default=200)
+    p.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    p.set_defaults(run=bench_parallel)
+    p = sub.add_parser('font', help='font registration with an empty vs. a warm metrics cache')
+    p.add_argument('--repeat', type=int, default=2)
+    p.set_defaults(run=bench_font)
+    p = sub.add_parser('long-table', help='one tall ReportLab table vs. fixed-size chunks')
+    p.add_argument('--rows', type=int, nargs='+', default=[100, 1000, 10000, 50000])
+    p.add_argument('--baseline-max', type=int, default=10000)
+    p.set_defaults(run=bench_long_table)
+    p = sub.add_parser('images', help='embedding raw screenshots vs. deduplicated, downscaled, cached ones')
+    p.add_argument('--screens', type=int, default=20)
+    p.add_argument('--repeat', type=int, default=3)
+    p.set_defaults(run=bench_images)
+    p = sub.add_parser('layout-cache', help='PDF build without, then with a cold and a warm paragraph layout cache')
+    p.add_argument('--copies', type=int, default=100)
+    p.set_defaults(run=bench_layout_cache)
+    p = sub.add_parser('fingerprint', help='rewriting the DOCX and PDF vs. finding them up to date')
+    p.add_argument('--copies', type=int, default=50)
+    p.add_argument('--repeat', type=int, default=3)
+    p.set_defaults(run=bench_fingerprint)
+    p = sub.add_parser('runs', help='PDF conversion with run formatting vs. flattened plain text')
+    p.add_argument('--steps', type=int, nargs='+', default=[1000, 10000])
+    p.add_argument('--copies', type=int, default=200)
+    p.add_argument('--repeat', type=int, default=3)
+    p.set_defaults(run=bench_runs)
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
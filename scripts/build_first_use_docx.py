@@ -1,18 +1,66 @@
+import argparse
+import hashlib
+import json
+import zipfile
+from copy import deepcopy
+from io import BytesIO
 from pathlib import Path
+from xml.sax.saxutils import escape
 from docx import Document
 from docx.shared import Inches, Pt, RGBColor
+from docx.enum.style import WD_STYLE_TYPE
 from docx.enum.text import WD_ALIGN_PARAGRAPH
 from docx.enum.section import WD_SECTION
 from docx.enum.table import WD_TABLE_ALIGNMENT, WD_CELL_VERTICAL_ALIGNMENT
-from docx.oxml import OxmlElement
+from docx.oxml import OxmlElement, parse_xml
+from docx.opc.constants import CONTENT_TYPE as CT, RELATIONSHIP_TYPE as RT
+from docx.opc.packuri import PackURI
+from docx.opc.part import Part
 from docx.oxml.ns import qn
+from docx.table import Table
+from lxml import etree
+import guide_fingerprint
+import guide_ir as ir
+import profiling
+from guide_images import ImageError, prepare_sections
+from guide_markdown import parse_sections
 
 ROOT = Path(__file__).resolve().parents[1]
+SRC = ROOT / 'docs' / '配置与首次使用.md'
 OUT = ROOT / 'docs' / 'SmartPages-配置与首次使用.docx'
+EXAMPLES = ROOT / 'docs' / 'examples'
+EXAMPLES_OUT = ROOT / 'build' / 'examples'
+CACHE_DIR = ROOT / '.cache' / 'docx-sections'
+SUBJECT = 'SmartPages 浏览器扩展精简使用指南'
+FOOTER = 'SmartPages 配置与首次使用'
+CUSTOM_PROPERTIES = 'http://schemas.openxmlformats.org/officeDocument/2006/custom-properties'
+VT = 'http://schemas.openxmlformats.org/officeDocument/2006/docPropsVTypes'
 
 BLUE = '2E74B5'
 DARK_BLUE = '1F4D78'
 HEADER_FILL = 'E8EEF5'
+# Compact mode: the formatting set_font writes for each kind of text, kept
+# once on a style. Paragraph styles also take the helpers' spacing.
+PARAGRAPH_FORMATS = {
+    'Normal': ((11, None, None), None),
+    'Heading 1': ((16, True, BLUE), (18, 10)),
+    'Heading 2': ((13, True, BLUE), (14, 7)),
+    'List Bullet': ((11, None, None), (None, 4)),
+    'List Number': ((11, None, None), (None, 4)),
+}
+CHARACTER_FORMATS = {
+    'SP Strong': (11, True, None),
+    'SP Label': (11, True, DARK_BLUE),
+    'SP Title': (24, True, DARK_BLUE),
+    'SP Subtitle': (12, None, '5B6472'),
+    'SP Code': (10, None, '1F2937'),
+    'SP Table': (10.5, None, None),
+    'SP Footer': (9, None, '6B7280'),
+}
+COMPRESS_LEVEL = 9
+TBL_PR_ORDER = [qn(f'w:{tag}') for tag in (
+    'tblStyle', 'tblpPr', 'tblOverlap', 'bidiVisual', 'tblStyleRowBandSize', 'tblStyleColBandSize', 'tblW', 'jc',
+    'tblCellSpacing', 'tblInd', 'tblBorders', 'shd', 'tblLayout', 'tblCellMar', 'tblLook', 'tblCaption', 'tblDescription')]
 
 
 def set_font(run, size=11, bold=None, color=None):
@@ -22,16 +70,18 @@ def set_font(run, size=11, bold=None, color=None):
     run._element.rPr.rFonts.set(qn('w:hAnsi'), 'Calibri')
     run.font.size = Pt(size)
     if bold is not None:
-        run.bold = bold
+        run.font.bold = bold
     if color:
         run.font.color.rgb = RGBColor.from_string(color)
 
 
 def set_cell_shading(cell, fill):
     tc_pr = cell._tc.get_or_add_tcPr()
-    shd = OxmlElement('w:shd')
+    shd = tc_pr.find(qn('w:shd'))
+    if shd is None:
+        shd = OxmlElement('w:shd')
+        tc_pr.append(shd)
     shd.set(qn('w:fill'), fill)
-    tc_pr.append(shd)
 
 
 def set_cell_width(cell, width_dxa):
@@ -44,7 +94,17 @@ def set_cell_width(cell, width_dxa):
     tc_w.set(qn('w:type'), 'dxa')
 
 
-def set_table_geometry(table, widths):
+def insert_tbl_pr(tbl_pr, child):
+    # Keep w:tblPr children in schema order; Word is strict about it.
+    for tag in TBL_PR_ORDER[TBL_PR_ORDER.index(child.tag) + 1:]:
+        successor = tbl_pr.find(tag)
+        if successor is not None:
+            successor.addprevious(child)
+            return
+    tbl_pr.append(child)
+
+
+def set_table_layout(table, widths):
     table.alignment = WD_TABLE_ALIGNMENT.LEFT
     table.autofit = False
     tbl_pr = table._tbl.tblPr
@@ -54,22 +114,44 @@ def set_table_geometry(table, widths):
     indent = OxmlElement('w:tblInd')
     indent.set(qn('w:w'), '120')
     indent.set(qn('w:type'), 'dxa')
-    tbl_pr.append(indent)
+    insert_tbl_pr(tbl_pr, indent)
+    margins = OxmlElement('w:tblCellMar')
+    for side in ('top', 'start', 'bottom', 'end'):
+        node = OxmlElement(f'w:{side}')
+        node.set(qn('w:w'), '80' if side in ('top', 'bottom') else '120')
+        node.set(qn('w:type'), 'dxa')
+        margins.append(node)
+    insert_tbl_pr(tbl_pr, margins)
     grid = table._tbl.tblGrid
     for col, width in zip(grid.gridCol_lst, widths):
         col.set(qn('w:w'), str(width))
+
+
+def set_table_geometry(table, widths):
+    set_table_layout(table, widths)
     for row in table.rows:
         for cell, width in zip(row.cells, widths):
             set_cell_width(cell, width)
             cell.vertical_alignment = WD_CELL_VERTICAL_ALIGNMENT.CENTER
-            tc_pr = cell._tc.get_or_add_tcPr()
-            margins = OxmlElement('w:tcMar')
-            for side in ('top', 'start', 'bottom', 'end'):
-                node = OxmlElement(f'w:{side}')
-                node.set(qn('w:w'), '80' if side in ('top', 'bottom') else '120')
-                node.set(qn('w:type'), 'dxa')
-                margins.append(node)
-            tc_pr.append(margins)
+
+
+def row_templates(table, widths, size):
+    # One header row and one body row styled through the usual helpers on a
+    # detached copy of the table; add_table clones these for every row.
+    scratch = Table(deepcopy(table._tbl), table._parent)
+    scratch.add_row()
+    scratch.add_row()
+    for row_i, row in enumerate(scratch.rows):
+        for cell, width in zip(row.cells, widths):
+            set_cell_width(cell, width)
+            cell.vertical_alignment = WD_CELL_VERTICAL_ALIGNMENT.CENTER
+            r = cell.paragraphs[0].add_run('-')
+            if row_i == 0:
+                set_cell_shading(cell, HEADER_FILL)
+                set_font(r, bold=True, color=DARK_BLUE)
+            else:
+                set_font(r, size=size)
+    return scratch._tbl.tr_lst
 
 
 def add_text(doc, text, style=None, bold_prefix=None):
@@ -115,20 +197,147 @@ def add_h2(doc, text):
     set_font(r, size=13, bold=True, color=BLUE)
 
 
-def add_note(doc, text):
+def add_code(doc, text):
+    p = doc.add_paragraph()
+    p.paragraph_format.left_indent = Inches(0.25)
+    p.paragraph_format.space_after = Pt(6)
+    r = p.add_run(text)
+    set_font(r, size=10, color='1F2937')
+
+
+def add_image(doc, path, width=None):
+    # python-docx keys image parts by SHA-1, so repeated screenshots share
+    # one media part and one relationship.
+    p = doc.add_paragraph()
+    p.alignment = WD_ALIGN_PARAGRAPH.CENTER
+    p.paragraph_format.space_after = Pt(8)
+    p.add_run().add_picture(str(path), width=Pt(width) if width else None)
+
+
+def add_table(doc, rows, widths, size=10.5):
+    table = doc.add_table(rows=0, cols=len(widths))
+    set_table_layout(table, widths)
+    header, body = row_templates(table, widths, size)
+    tbl = table._tbl
+    for row_i, values in enumerate(rows):
+        tr = deepcopy(header if row_i == 0 else body)
+        for t, text in zip(list(tr.iter(qn('w:t'))), list(values) + [''] * (len(widths) - len(values))):
+            if '\n' in text or text != text.strip():
+                t.getparent().text = text
+            else:
+                t.text = text
+        tbl.append(tr)
+    return table
+
+
+def add_note(doc, text, label=None):
     table = doc.add_table(rows=1, cols=1)
     set_table_geometry(table, [9360])
     cell = table.cell(0, 0)
     set_cell_shading(cell, 'F4F6F9')
     p = cell.paragraphs[0]
     p.paragraph_format.space_after = Pt(0)
-    r = p.add_run('重要提示：')
+    r = p.add_run(label or '重要提示：')
     set_font(r, bold=True, color=DARK_BLUE)
     r = p.add_run(text)
     set_font(r)
 
 
-def setup(doc):
+def add_compact_styles(doc):
+    for name, ((size, bold, color), spacing) in PARAGRAPH_FORMATS.items():
+        style = doc.styles[name]
+        if style._element.rPr is not None:
+            style._element.remove(style._element.rPr)
+        set_font(style, size=size, bold=bold, color=color)
+        if spacing:
+            before, after = spacing
+            if before is not None:
+                style.paragraph_format.space_before = Pt(before)
+            style.paragraph_format.space_after = Pt(after)
+    for name, (size, bold, color) in CHARACTER_FORMATS.items():
+        style = doc.styles.add_style(name, WD_STYLE_TYPE.CHARACTER)
+        set_font(style, size=size, bold=bold, color=color)
+
+
+def canonical(element):
+    return etree.tostring(element, method='c14n', exclusive=True)
+
+
+def compact_formats(styles):
+    # Canonical rPr of the SP character styles, and the rPr and pPr children
+    # of each paragraph style, for compact_formatting.
+    char_styles = {}
+    para_styles = {}
+    default = None
+    for style in styles.iterchildren(qn('w:style')):
+        style_id = style.get(qn('w:styleId'))
+        r_pr = style.find(qn('w:rPr'))
+        if style.get(qn('w:type')) == 'character' and style_id.startswith('SP') and r_pr is not None:
+            char_styles[canonical(r_pr)] = style_id
+        elif style.get(qn('w:type')) == 'paragraph':
+            p_pr = style.find(qn('w:pPr'))
+            children = {child.tag: canonical(child) for child in p_pr} if p_pr is not None else {}
+            para_styles[style_id] = (canonical(r_pr) if r_pr is not None else None, children)
+            if style.get(qn('w:default')) in ('1', 'true'):
+                default = style_id
+    return char_styles, para_styles, default
+
+
+def compact_formatting(root, formats):
+    # Drop paragraph and run properties that repeat the paragraph style, and
+    # point runs whose properties match one of the SP character styles at it.
+    char_styles, para_styles, default = formats
+    for p in root.iter(qn('w:p')):
+        p_pr = p.find(qn('w:pPr'))
+        p_style = p_pr.find(qn('w:pStyle')) if p_pr is not None else None
+        run_props, para_props = para_styles.get(p_style.get(qn('w:val')) if p_style is not None else default, (None, {}))
+        if p_pr is not None:
+            for child in list(p_pr):
+                if child.tag != qn('w:pStyle') and para_props.get(child.tag) == canonical(child):
+                    p_pr.remove(child)
+            if len(p_pr) == 0:
+                p.remove(p_pr)
+        for r in p.iterchildren(qn('w:r')):
+            r_pr = r.find(qn('w:rPr'))
+            if r_pr is None:
+                continue
+            key = canonical(r_pr)
+            if key == run_props:
+                r.remove(r_pr)
+            elif key in char_styles:
+                for child in list(r_pr):
+                    r_pr.remove(child)
+                r_style = OxmlElement('w:rStyle')
+                r_style.set(qn('w:val'), char_styles[key])
+                r_pr.append(r_style)
+
+
+def save_docx(doc, out, compresslevel=None):
+    if compresslevel is None:
+        doc.save(out)
+        return
+    package = BytesIO()
+    doc.save(package)
+    with zipfile.ZipFile(package) as src, zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED, compresslevel=compresslevel) as dst:
+        for info in src.infolist():
+            dst.writestr(info, src.read(info), compresslevel=compresslevel)
+
+
+def docx_sizes(path):
+    try:
+        with zipfile.ZipFile(path) as zf:
+            return Path(path).stat().st_size, zf.getinfo('word/document.xml').file_size
+    except (OSError, KeyError, zipfile.BadZipFile):
+        return None
+
+
+def size_change(before, after):
+    if not before:
+        return f'{after:,} bytes'
+    return f'{before:,} -> {after:,} bytes ({(after - before) / before * 100:+.0f}%)'
+
+
+def setup(doc, footer='SmartPages 配置与首次使用', compact=False):
     sec = doc.sections[0]
     sec.top_margin = sec.bottom_margin = sec.left_margin = sec.right_margin = Inches(1)
     sec.header_distance = Inches(0.492)
@@ -142,157 +351,188 @@ def setup(doc):
     for name in ('Heading 1', 'Heading 2', 'Heading 3'):
         doc.styles[name].font.name = 'Calibri'
         doc.styles[name]._element.rPr.rFonts.set(qn('w:eastAsia'), 'Microsoft YaHei')
+    if compact:
+        add_compact_styles(doc)
     footer_p = sec.footer.paragraphs[0]
     footer_p.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-    r = footer_p.add_run('SmartPages 配置与首次使用')
+    r = footer_p.add_run(footer)
     set_font(r, size=9, color='6B7280')
+    if compact:
+        compact_formatting(sec.footer._element, compact_formats(doc.styles.element))
 
 
-def build():
-    doc = Document()
-    setup(doc)
+def add_title(doc, text):
     title = doc.add_paragraph()
     title.alignment = WD_ALIGN_PARAGRAPH.CENTER
     title.paragraph_format.space_after = Pt(4)
-    r = title.add_run('SmartPages 配置与首次使用')
+    r = title.add_run(text)
     set_font(r, size=24, bold=True, color=DARK_BLUE)
+
+
+def add_subtitle(doc, text):
     sub = doc.add_paragraph()
     sub.alignment = WD_ALIGN_PARAGRAPH.CENTER
     sub.paragraph_format.space_after = Pt(18)
-    r = sub.add_run('从安装、模型配置到首次生成文档')
+    r = sub.add_run(text)
     set_font(r, size=12, color='5B6472')
-    add_text(doc, '精简版：完成以下四步即可开始使用 SmartPages。')
-
-    add_h1(doc, '1. 下载并安装')
-    add_number(doc, '访问 https://github.com/Teddy9710/smartpages/releases/tag/v1.3.0，下载并解压 SmartPages v1.3.0 扩展包。')
-    add_number(doc, '打开 chrome://extensions/ 或 edge://extensions/，开启“开发者模式”。')
-    add_number(doc, '点击“加载已解压的扩展程序”，选择解压后包含 manifest.json 的目录。')
-
-    add_h1(doc, '2. 配置模型')
-    add_number(doc, '点击扩展图标，打开“设置”，选择模型服务商并填写 API Key。')
-    add_number(doc, '推荐选择 GPT / OpenAI、Gemini、Claude、GLM、DeepSeek、Kimi、MiniMax、OpenRouter、SiliconFlow 或阿里云百炼；也可填写自定义 OpenAI-compatible API。')
-    add_number(doc, '点击“测试连接”，成功后点击“保存配置”。每个服务商会独立保存 API Key、Base URL、模型和图片设置，切换时自动恢复。最大输出 Token 建议设为 3000–6000。')
-
-    add_h1(doc, '3. 首次录制与生成')
-    add_number(doc, '打开目标网页，点击扩展图标后选择“开始录制”。')
-    add_number(doc, '按正常路径完成操作；完成后点击“停止录制”，再打开编辑器。')
-    add_number(doc, '确认录制步骤，选择或输入文档描述，点击“生成文档”。')
-    add_number(doc, '在预览中修改内容；需要时导出 Markdown、HTML、Word 或 PDF。')
-
-    add_h1(doc, '4. 注意事项')
-    add_bullet(doc, '不要在录制期间输入密码、验证码、Token 或其他敏感信息。')
-    add_bullet(doc, '测试连接失败时，检查 API Key、Base URL、模型名称和网络权限。')
-    add_bullet(doc, '生成内容过短时，提高最大输出 Token，或改用更适合长文生成的模型。')
-    add_note(doc, '录制步骤会在生成文档时发送给所配置的模型服务。只有启用“模型支持图片输入”后，未隐藏的步骤截图才会随请求发送给模型，每次最多 12 张。')
-    doc.core_properties.title = 'SmartPages 配置与首次使用（精简版）'
-    doc.core_properties.subject = 'SmartPages 浏览器扩展精简使用指南'
-    doc.core_properties.author = 'SmartPages'
-    doc.save(OUT)
-    return
-    add_text(doc, 'SmartPages 是一个 Chrome / Edge 扩展：它记录网页上的操作步骤和截图，再通过你配置的大模型生成用户指南、教程、测试用例或问题报告等文档。本文面向第一次使用者。')
-
-    add_h1(doc, '1. 使用前准备')
-    add_text(doc, '首先下载扩展包：访问 https://github.com/Teddy9710/smartpages/releases/tag/v1.3.0，下载 SmartPages v1.3.0 Release 提供的扩展包并解压到本地目录。后续加载扩展时，请选择其中包含 manifest.json 的目录。')
-    for item in ['Chrome 或 Edge 浏览器。', '一个可用的大模型 API Key。SmartPages 支持 OpenAI-compatible Chat Completions API，以及 Anthropic Messages API（Claude）。', '如果从源码使用，需安装 Node.js（建议使用当前 LTS 版本）和 npm。']:
-        add_bullet(doc, item)
-    add_text(doc, '内置服务预设及设置页推荐模型：')
-    model_table = doc.add_table(rows=1, cols=3)
-    set_table_geometry(model_table, [2700, 2500, 4160])
-    for cell, text in zip(model_table.rows[0].cells, ['服务', 'API 格式', '推荐模型']):
-        set_cell_shading(cell, HEADER_FILL)
-        r = cell.paragraphs[0].add_run(text)
-        set_font(r, bold=True, color=DARK_BLUE)
-    model_rows = [
-        ('GPT / OpenAI', 'OpenAI-compatible', 'gpt-4o-mini'),
-        ('Gemini / Google', 'OpenAI-compatible', 'gemini-3-flash-preview'),
-        ('Claude / Anthropic', 'Anthropic Messages', 'claude-sonnet-4-20250514'),
-        ('GLM / Z.AI', 'OpenAI-compatible', 'glm-4.5'),
-        ('DeepSeek', 'OpenAI-compatible', 'deepseek-chat'),
-        ('MiniMax', 'OpenAI-compatible', 'MiniMax-M1'),
-        ('Kimi / Moonshot', 'OpenAI-compatible', 'moonshot-v1-8k'),
-        ('OpenRouter', 'OpenAI-compatible', 'openai/gpt-4o-mini'),
-        ('SiliconFlow', 'OpenAI-compatible', 'deepseek-ai/DeepSeek-V3'),
-        ('阿里云百炼 DashScope', 'OpenAI-compatible', 'qwen-plus'),
-        ('自定义兼容服务', 'OpenAI-compatible', '按服务商文档填写'),
-    ]
-    for values in model_rows:
-        cells = model_table.add_row().cells
-        for cell, text in zip(cells, values):
-            r = cell.paragraphs[0].add_run(text)
-            set_font(r, size=9.5)
-    add_text(doc, '以上是项目当前预设的默认值；只要服务兼容相应 API 格式，也可以在设置页手动填写 Base URL 和模型名称。')
-    add_note(doc, '请勿在录制中输入密码、验证码、访问令牌、身份证号等敏感信息。录制步骤会发送给所配置的模型服务；启用“模型支持图片输入”后，未隐藏的步骤截图也会随请求发送。')
-
-    add_h1(doc, '2. 安装扩展')
-    add_h2(doc, '方式 A：加载下载并解压的 Release 扩展包')
-    add_text(doc, '适合首次使用。请先完成“使用前准备”中的 v1.3.0 Release 下载与解压。')
-    for item in ['在 Chrome 打开 chrome://extensions/，或在 Edge 打开 edge://extensions/。', '打开右上角的“开发者模式”。', '点击“加载已解压的扩展程序”。', '选择刚刚解压的、包含 manifest.json 的 SmartPages 目录。', '将 SmartPages 固定到浏览器工具栏，便于录制时打开。']:
-        add_number(doc, item)
-    add_h2(doc, '方式 B：构建后加载 dist')
-    add_text(doc, '在 PowerShell 中执行：')
-    p = doc.add_paragraph()
-    p.paragraph_format.left_indent = Inches(0.25)
-    p.paragraph_format.space_after = Pt(6)
-    r = p.add_run('cd D:\\smartpages\nnpm install\nnpm run build')
-    set_font(r, size=10, color='1F2937')
-    add_text(doc, '随后在扩展管理页选择“加载已解压的扩展程序”，并选择 D:\\smartpages\\dist。每次修改源码后重新运行 npm run build，再点击“重新加载”。')
-
-    add_h1(doc, '3. 配置模型服务')
-    for item in ['点击浏览器工具栏中的 SmartPages 图标，选择“设置”。', '在“模型服务商”选择所用服务。选择后会自动填写推荐的 Base URL、模型名和 API 格式，均可再手动调整。', '填写 API Key；如使用自定义兼容服务，同时填写 Base URL 和模型名称。', '建议将“最大输出 Token”设为 3000–6000。文档较长时可提高；设置过小可能导致生成内容被截断。', '保持“最大输入 Token”默认值即可。输入很长时，系统会保留前后内容并省略中间部分。', '选择默认输出格式：Markdown、HTML 或纯文本。', '点击“测试连接”。浏览器首次访问该 API 域名时，请允许 SmartPages 请求站点访问权限。', '测试成功后点击“保存配置”。']:
-        add_number(doc, item)
-    add_text(doc, 'API Key 和其他配置按服务商分别保存在浏览器的本地存储中，不会写入项目仓库；正常更新 SmartPages 版本不会清除这些配置。')
-    add_h2(doc, '支持的预设服务')
-    add_text(doc, '设置页提供 GPT / OpenAI、Gemini、Claude、GLM、DeepSeek、MiniMax、Kimi、OpenRouter、SiliconFlow、阿里云百炼 DashScope，以及“自定义 OpenAI-compatible API”预设。Claude 使用 Anthropic Messages API；其余预设使用 OpenAI-compatible 格式。')
-    add_h2(doc, '让生成结果更贴近团队规范（可选）')
-    for item in ['追加要求：在默认提示词后追加具体要求，例如“每个步骤说明页面反馈，并增加故障排查章节”。', '自定义提示词：完全替换默认提示词。可使用 {{taskDescription}}、{{sessionInfo}}、{{steps}} 等占位符。', '风格指南：输入团队的语言、标题、表格和截图占位规范；支持纯文本、Markdown 和 HTML。', '示例文档与参考文档：可上传 TXT、MD 或 HTML 文件，或直接粘贴用户操作指南、教程、测试用例、问题报告示例。']:
-        add_bullet(doc, item)
-
-    add_h1(doc, '4. 第一次使用：录制并生成一篇文档')
-    add_text(doc, '以下以“为某个网页功能写用户操作指南”为例。')
-    for item in ['打开要记录的网页。首次录制某个页面时，建议先刷新该页面。', '点击 SmartPages 图标，点击“开始录制”。', '按真实使用路径完成操作。扩展会记录点击、输入、页面跳转和关键步骤截图。', '遇到无关操作可点击“暂停录制”；继续时点击“继续录制”。请避免在录制期间输入敏感内容。', '完成后点击“停止录制”，再点击“打开编辑器”。', '在侧边栏确认、删除、排序或改写录制步骤。', '选择系统推测的文档目标，或选择“自定义描述”并明确输入受众、目的和章节要求。', '点击“生成文档”，等待模型返回内容。', '在“预览”中直接修改内容，或切换到“编辑”修改 Markdown 源码。需要改写时，点击“优化”并输入具体优化要求；可用“回退”恢复优化前版本。', '点击“复制”或“下载”交付文档。工具栏还可导出 HTML、Word、PDF；PDF 会打开浏览器打印窗口，请选择“另存为 PDF”。']:
-        add_number(doc, item)
-
-    add_h1(doc, '5. 常见首次使用问题')
-    table = doc.add_table(rows=1, cols=2)
-    set_table_geometry(table, [2500, 6860])
-    headers = ['现象', '建议处理']
-    for cell, text in zip(table.rows[0].cells, headers):
-        set_cell_shading(cell, HEADER_FILL)
-        p = cell.paragraphs[0]
-        r = p.add_run(text)
-        set_font(r, bold=True, color=DARK_BLUE)
-    rows = [
-        ('点击“开始录制”后没有记录操作', '刷新目标网页后重试；某些网站可能限制脚本注入。'),
-        ('测试连接失败', '检查 API Key、Base URL、模型名、网络，以及是否允许 SmartPages 访问该 API 域名。'),
-        ('生成失败或内容很短', '先测试连接；提高最大输出 Token；使用更适合长文生成的模型。'),
-        ('生成结果不符合预期', '在自定义描述中补足受众、目的和章节要求；再使用“追加要求”或风格指南约束输出。'),
-        ('录制内容包含敏感数据', '不要将该记录提交给模型；清理录制缓存并重新录制，且在敏感步骤暂停录制。'),
-    ]
-    for left, right in rows:
-        cells = table.add_row().cells
-        for cell, text in zip(cells, (left, right)):
-            p = cell.paragraphs[0]
-            r = p.add_run(text)
-            set_font(r, size=10.5)
-
-    add_h1(doc, '6. 可选：导出与测试可执行工作流')
-    add_text(doc, '完成一次录制和文档生成后，侧边栏的“工作流”可以导出 .smartpages.json。该文件用于同一站点、受控场景下的步骤回放；它不等同于通用网页自动化脚本。')
-    for item in ['“测试运行”会在当前浏览器标签页回放工作流。', '页面操作有风险或需要运行时输入时，扩展会暂停并要求确认或填写变量。', '工作流只允许访问文件中明确声明的 HTTP/HTTPS 来源，不支持通配来源。', '密码、Token 等敏感值不应写入或提交到 .smartpages.json。']:
-        add_bullet(doc, item)
-
-    add_h1(doc, '7. 可选：本地 Agent Bridge（实验性）')
-    for item in ['在侧边栏导出 .smartpages.json，放到 %LOCALAPPDATA%\\SmartPages\\workflows\\。', '在项目根目录启动 Bridge：npm run mcp:serve。', '记录终端输出的 host、port 和 token。', '打开 SmartPages 设置，在“本地 Agent Bridge”中启用功能，填入 127.0.0.1、port 和 token，然后点击“测试 Agent Bridge”。', '在 Agent 的 MCP 配置中添加 smartpages-mcp，即可使用 list_workflows、start_run、get_run_status 和 cancel_run。']:
-        add_number(doc, item)
-    add_text(doc, '该 Bridge 仅监听本机连接，实际网页操作仍由安装了 SmartPages 的 Chrome/Edge 完成。首次在本地演示页面运行工作流时，若浏览器请求访问 http://localhost/*，请允许该权限。')
-
-    add_h1(doc, '8. 日常更新与验证')
-    add_text(doc, '开发时可使用 npm run dev、npm test、npm run lint、npm run typecheck 和 npm run verify。更新扩展后，重新加载扩展并刷新正在录制的网页，再开始新的录制会话。')
-    doc.core_properties.title = 'SmartPages 配置与首次使用'
-    doc.core_properties.subject = 'SmartPages 浏览器扩展使用指南'
+
+
+def emit(doc, block):
+    if isinstance(block, ir.Title):
+        add_title(doc, block.text)
+    elif isinstance(block, ir.Subtitle):
+        add_subtitle(doc, block.text)
+    elif isinstance(block, ir.Heading):
+        (add_h1 if block.level == 1 else add_h2)(doc, block.text)
+    elif isinstance(block, ir.NumberItem):
+        add_number(doc, block.text)
+    elif isinstance(block, ir.Bullet):
+        add_bullet(doc, block.text)
+    elif isinstance(block, ir.Note):
+        add_note(doc, block.text, block.label)
+    elif isinstance(block, ir.Code):
+        add_code(doc, block.text)
+    elif isinstance(block, ir.Table):
+        add_table(doc, block.rows, block.column_widths())
+    elif isinstance(block, ir.Image):
+        add_image(doc, block.path, block.width)
+    else:
+        add_text(doc, block.text, bold_prefix=block.bold_prefix)
+
+
+def body_content(body):
+    return [child for child in body.iterchildren() if child.tag != qn('w:sectPr')]
+
+
+def append_content(body, elements):
+    sect_pr = body.find(qn('w:sectPr'))
+    for element in elements:
+        if sect_pr is None:
+            body.append(element)
+        else:
+            sect_pr.addprevious(element)
+
+
+def add_custom_properties(doc, values):
+    # String entries in docProps/custom.xml, where a build can record what it
+    # was made from without touching the core properties.
+    props = ''.join(
+        f'<property fmtid="{{D5CDD505-2E9C-101B-9397-08002B2CF9AE}}" pid="{pid}" name="{escape(name)}"><vt:lpwstr>{escape(value)}</vt:lpwstr></property>'
+        for pid, (name, value) in enumerate(values.items(), 2)
+    )
+    xml = f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n<Properties xmlns="{CUSTOM_PROPERTIES}" xmlns:vt="{VT}">{props}</Properties>'
+    package = doc.part.package
+    package.relate_to(Part(PackURI('/docProps/custom.xml'), CT.OFC_CUSTOM_PROPERTIES, xml.encode('utf-8'), package), RT.CUSTOM_PROPERTIES)
+
+
+def compiler_key():
+    # Any change to the helpers or the parser invalidates every cached fragment.
+    digest = hashlib.sha256()
+    for name in ('build_first_use_docx.py', 'guide_ir.py', 'guide_markdown.py', 'guide_images.py'):
+        path = Path(__file__).with_name(name)
+        digest.update(path.read_bytes())
+    return digest.hexdigest()
+
+
+def build(src=SRC, out=OUT, subject=None, footer=None, cache_dir=CACHE_DIR, sections=None, compact=False, force=False, keep_duplicates=False):
+    if sections is None:
+        with profiling.span('docx.parse'):
+            sections = parse_sections(Path(src).read_text(encoding='utf-8'))
+        with profiling.span('docx.images'):
+            sections = prepare_sections(sections, Path(src).parent, src=src, keep_duplicates=keep_duplicates)
+    guide = ir.Guide([block for section in sections for block in section.blocks])
+    title = guide.title or Path(src).stem
+    subject = subject or guide.subtitle or title
+    footer = footer or title
+    prefix = compiler_key()
+    if not force:
+        # Leave the file alone when it already has these blocks, properties
+        # and generator: its bytes would only differ in timestamps.
+        with profiling.span('docx.fingerprint'):
+            stale = guide_fingerprint.docx_diff(out, guide.blocks, title, subject, footer, compact, prefix[:12])
+        if not stale:
+            print(f'{out} (up to date)')
+            return None
+    with profiling.span('docx.setup'):
+        doc = Document()
+        setup(doc, footer=footer, compact=compact)
+    body = doc.element.body
+    # Each output has its own fragments, and only the ones this build used
+    # are kept, so the cache tracks the document instead of every revision.
+    cache_dir = Path(cache_dir) / hashlib.sha256(str(Path(out).resolve()).encode('utf-8')).hexdigest()
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    reused = 0
+    used = set()
+    for section in sections:
+        # Pictures carry relationship ids into the body XML, which are only
+        # valid in the package that created them, so those sections are
+        # always rebuilt.
+        cacheable = not any(isinstance(block, ir.Image) for block in section.blocks)
+        key = hashlib.sha256((prefix + section.source).encode('utf-8')).hexdigest()
+        cached = cache_dir / f'{key}.json'
+        if cacheable:
+            used.add(cached.name)
+        if cacheable and cached.exists():
+            with profiling.span('docx.cache'):
+                append_content(body, [parse_xml(xml) for xml in json.loads(cached.read_text(encoding='utf-8'))])
+            reused += 1
+            continue
+        start = len(body_content(body))
+        with profiling.span('docx.emit'):
+            for block in section.blocks:
+                emit(doc, block)
+        if cacheable:
+            with profiling.span('docx.cache'):
+                fragment = [element.xml for element in body_content(body)[start:]]
+                cached.write_text(json.dumps(fragment, ensure_ascii=False), encoding='utf-8')
+    for path in cache_dir.glob('*.json'):
+        if path.name not in used:
+            path.unlink()
+    doc.core_properties.title = title
+    doc.core_properties.subject = subject
     doc.core_properties.author = 'SmartPages'
-    doc.save(OUT)
-    print(OUT)
+    add_custom_properties(doc, {guide_fingerprint.GENERATOR: prefix[:12], guide_fingerprint.SOURCE: guide_fingerprint.blocks_digest(guide.blocks)})
+    if compact:
+        with profiling.span('docx.compact'):
+            compact_formatting(body, compact_formats(doc.styles.element))
+    before = docx_sizes(out) if compact else None
+    with profiling.span('docx.save'):
+        save_docx(doc, out, COMPRESS_LEVEL if compact else None)
+    if profiling.ENABLED:
+        profiling.count('docx.sections', len(sections))
+        profiling.count('docx.sections_cached', reused)
+        profiling.count('docx.blocks', len(guide.blocks))
+        profiling.count('docx.paragraphs', sum(1 for _ in body.iter(qn('w:p'))))
+        profiling.count('docx.runs', sum(1 for _ in body.iter(qn('w:r'))))
+        profiling.count('docx.cells', sum(1 for _ in body.iter(qn('w:tc'))))
+        profiling.count('docx.bytes_written', Path(out).stat().st_size)
+    print(f'{out} ({reused}/{len(sections)} sections cached)')
+    if compact:
+        size, xml_size = docx_sizes(out)
+        print(f'  compact docx: file {size_change(before and before[0], size)}, document.xml {size_change(before and before[1], xml_size)}')
+    return reused, len(sections)
+
+
+def build_examples(out_dir=EXAMPLES_OUT, force=False, keep_duplicates=False):
+    Path(out_dir).mkdir(parents=True, exist_ok=True)
+    for src in sorted(EXAMPLES.glob('*.md')):
+        if src.name != 'README.md':
+            build(src, Path(out_dir) / f'{src.stem}.docx', force=force, keep_duplicates=keep_duplicates)
 
 
 if __name__ == '__main__':
-    build()
+    parser = argparse.ArgumentParser(description='Build the first-use guide DOCX from its Markdown source.')
+    parser.add_argument('--examples', action='store_true', help='also build the Markdown examples')
+    parser.add_argument('--compact', action='store_true', help='keep run formatting in styles and compress harder')
+    parser.add_argument('--force', action='store_true', help='rewrite the DOCX even if it is up to date')
+    parser.add_argument('--keep-duplicates', action='store_true', help='keep consecutive screenshots with the same pixels')
+    parser.add_argument('--profile', metavar='REPORT', help='write a JSON timing report')
+    parser.add_argument('--cprofile', metavar='STATS', help='write a cProfile dump')
+    args = parser.parse_args()
+    try:
+        with profiling.session('build_first_use_docx', args.profile, args.cprofile):
+            build(subject=SUBJECT, footer=FOOTER, compact=args.compact, force=args.force, keep_duplicates=args.keep_duplicates)
+            if args.examples:
+                build_examples(force=args.force, keep_duplicates=args.keep_duplicates)
+    except ImageError as e:
+        parser.exit(1, f'{e}\n')
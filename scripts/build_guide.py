@@ -0,0 +1,130 @@
+import argparse
+import time
+from contextlib import redirect_stdout
+from io import StringIO
+from pathlib import Path
+import build_first_use_docx
+import convert_first_use_pdf
+import guide_fingerprint
+import guide_ir as ir
+import profiling
+from guide_ir import Guide
+from guide_images import ImageError, prepare_sections
+from guide_markdown import parse_sections
+from pdf_fonts import FontNotFoundError
+
+
+def build(src=build_first_use_docx.SRC, docx_out=build_first_use_docx.OUT, pdf_out=convert_first_use_pdf.OUT, compact=False, force=False, keep_duplicates=False, **docx_options):
+    # Parse the Markdown once and hand the same blocks to both backends.
+    with profiling.span('guide.parse'):
+        sections = parse_sections(Path(src).read_text(encoding='utf-8'))
+    with profiling.span('guide.images'):
+        sections = prepare_sections(sections, Path(src).parent, src=src, keep_duplicates=keep_duplicates)
+    build_first_use_docx.build(src, docx_out, sections=sections, compact=compact, force=force, **docx_options)
+    guide = Guide([block for section in sections for block in section.blocks])
+    convert_first_use_pdf.build(out=pdf_out, guide=guide, compact=compact, force=force, footer=docx_options.get('footer'))
+
+
+def watched_paths(src, sections):
+    # The Markdown file plus every image it references.
+    paths = [Path(src).resolve()]
+    for section in sections:
+        for block in section.blocks:
+            if isinstance(block, ir.Image):
+                paths.append((Path(src).parent / block.path).resolve())
+    return paths
+
+
+def snapshot(paths):
+    state = {}
+    for path in paths:
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            state[path] = None
+        else:
+            state[path] = (stat.st_mtime_ns, stat.st_size)
+    return state
+
+
+def watch(src=build_first_use_docx.SRC, docx_out=build_first_use_docx.OUT, pdf_out=convert_first_use_pdf.OUT, interval=0.2, debounce=0.3, compact=False, keep_duplicates=False, **docx_options):
+    # Stays resident so python-docx, ReportLab, the registered font and the
+    # paragraph styles are loaded once. An output is only rebuilt when the
+    # blocks it is made from change or the file has gone missing; the DOCX
+    # then still reuses every unchanged section from the fragment cache.
+    convert_first_use_pdf.register_font()
+    styles = convert_first_use_pdf.make_styles()
+    built = {}
+    paths = [Path(src).resolve()]
+    print(f'watching {src}')
+    while True:
+        state = snapshot(paths)
+        start = time.perf_counter()
+        try:
+            sections = parse_sections(Path(src).read_text(encoding='utf-8'))
+            paths = watched_paths(src, sections)
+            state.update(snapshot(path for path in paths if path not in state))
+            sections = prepare_sections(sections, Path(src).parent, src=src, keep_duplicates=keep_duplicates)
+            blocks = [block for section in sections for block in section.blocks]
+            digest = guide_fingerprint.blocks_digest(blocks)
+            parts = []
+            with redirect_stdout(StringIO()):
+                if built.get(docx_out) != digest or not Path(docx_out).exists():
+                    result = build_first_use_docx.build(src, docx_out, sections=sections, compact=compact, **docx_options)
+                    built[docx_out] = digest
+                    if result is None:
+                        parts.append('docx up to date')
+                    else:
+                        parts.append('docx rebuilt ({}/{} sections cached)'.format(*result))
+                else:
+                    parts.append('docx unchanged')
+                if built.get(pdf_out) != digest or not Path(pdf_out).exists():
+                    pages = convert_first_use_pdf.build(out=pdf_out, guide=Guide(blocks), styles=styles, compact=compact, footer=docx_options.get('footer'))
+                    built[pdf_out] = digest
+                    parts.append('pdf up to date' if pages is None else 'pdf rebuilt (font and styles warm)')
+                else:
+                    parts.append('pdf unchanged')
+            message = ', '.join(parts)
+        except Exception as e:
+            message = f'build failed: {type(e).__name__}: {e}'
+        print(f'{time.strftime("%H:%M:%S")} {message} in {time.perf_counter() - start:.2f}s', flush=True)
+        while snapshot(paths) == state:
+            time.sleep(interval)
+        # Editors often write a file in several steps; wait for it to settle.
+        state = snapshot(paths)
+        while True:
+            time.sleep(debounce)
+            current = snapshot(paths)
+            if current == state:
+                break
+            state = current
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build the guide DOCX and PDF from one parse of the Markdown source.')
+    parser.add_argument('src', nargs='?', type=Path)
+    parser.add_argument('docx_out', nargs='?', type=Path, default=build_first_use_docx.OUT)
+    parser.add_argument('pdf_out', nargs='?', type=Path, default=convert_first_use_pdf.OUT)
+    parser.add_argument('--watch', action='store_true', help='stay running and rebuild when the source or its images change')
+    parser.add_argument('--interval', type=float, default=0.2, help='polling interval in seconds (with --watch)')
+    parser.add_argument('--debounce', type=float, default=0.3, help='quiet period before rebuilding (with --watch)')
+    parser.add_argument('--compact', action='store_true', help='smaller DOCX and PDF output (styles instead of direct formatting, binary streams)')
+    parser.add_argument('--force', action='store_true', help='rewrite outputs even if they are up to date')
+    parser.add_argument('--keep-duplicates', action='store_true', help='keep consecutive screenshots with the same pixels')
+    args = parser.parse_args()
+    # Without arguments the checked-in guide is built with its own metadata.
+    options = {} if args.src else {'subject': build_first_use_docx.SUBJECT, 'footer': build_first_use_docx.FOOTER}
+    src = args.src or build_first_use_docx.SRC
+    if args.watch:
+        try:
+            watch(src, args.docx_out, args.pdf_out, args.interval, args.debounce, args.compact, args.keep_duplicates, **options)
+        except KeyboardInterrupt:
+            pass
+        except FontNotFoundError as e:
+            parser.exit(1, f'{e}\n')
+    else:
+        try:
+            with profiling.session('build_guide'):
+                build(src, args.docx_out, args.pdf_out, args.compact, args.force, args.keep_duplicates, **options)
+        except (FontNotFoundError, ImageError) as e:
+            parser.exit(1, f'{e}\n')
@@ -0,0 +1,188 @@
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import convert_first_use_pdf
+import guide_ir as ir
+from convert_first_use_pdf import binary_streams, draw_footer, init_worker, new_template, story_from_blocks
+from docx_stream import write_docx
+from pdf_fonts import FontNotFoundError
+from workflow_schema import WorkflowError, non_empty, validate_workflow
+
+SUFFIX = '.smartpages.json'
+MANIFEST = '.smartpages-build.json'
+ACTION_LABELS = {'navigate': '打开页面', 'click': '点击', 'input': '输入', 'select': '选择', 'scroll': '滚动', 'wait': '等待', 'assert': '检查'}
+RISK_LABELS = {'low': '低', 'medium': '中', 'high': '高'}
+HIGH_RISK_NOTE = '该步骤会提交或修改数据，执行前请确认。'
+# Besides everything convert_first_use_pdf.compiler_key() covers.
+SOURCES = ('build_workflows.py', 'workflow_schema.py', 'build_first_use_docx.py', 'docx_stream.py', 'profiling.py')
+
+
+def target_label(target):
+    if isinstance(target, str):
+        return target.strip()
+    if isinstance(target, dict):
+        for hint in ('name', 'text', 'role', 'selector', 'rawSelector', 'tagName'):
+            if non_empty(target.get(hint)):
+                return target[hint].strip()
+    return ''
+
+
+def value_label(value):
+    if isinstance(value, dict) and non_empty(value.get('variable')):
+        return '{{' + value['variable'] + '}}'
+    return '' if value is None else str(value)
+
+
+def describe(step):
+    if non_empty(step.get('description')):
+        return step['description'].strip()
+    action = step['action']
+    target = target_label(step.get('target'))
+    data = step.get('input') if isinstance(step.get('input'), dict) else {}
+    if action == 'navigate':
+        return f'打开 {data.get("url") or target}'
+    if action == 'scroll':
+        return f'滚动页面到 ({data.get("x", 0)}, {data.get("y", 0)})'
+    if action in ('input', 'select'):
+        return f'在“{target}”中{ACTION_LABELS[action]} {value_label(data.get("value"))}'.rstrip()
+    if action == 'click':
+        return f'点击“{target}”'
+    if action == 'wait':
+        return f'等待“{target}”出现' if target else '等待页面就绪'
+    return f'确认“{target}”' if target else '确认页面状态'
+
+
+def guide_from_workflow(workflow):
+    workflow_id = workflow['workflowId']
+    version = int(workflow['workflowVersion'])
+    title = workflow['title'].strip() if non_empty(workflow.get('title')) else workflow_id
+    steps = workflow['steps']
+    info = [
+        ['项目', '内容'],
+        ['工作流 ID', workflow_id],
+        ['版本', str(version)],
+        ['允许的网站', '\n'.join(workflow['allowedOrigins'])],
+        ['步骤数', str(len(steps))],
+    ]
+    if non_empty(workflow.get('generatedAt')):
+        info.append(['生成时间', workflow['generatedAt']])
+    blocks = [ir.Title(title), ir.Subtitle(f'{workflow_id} · 版本 {version}'), ir.Heading(1, '基本信息'), ir.Table(info)]
+    variables = [v for v in workflow['variables'] if isinstance(v, dict) and non_empty(v.get('name'))]
+    if variables:
+        rows = [['名称', '必填', '敏感']]
+        rows += [[v['name'], '是' if v.get('required') else '否', '是' if v.get('secret') else '否'] for v in variables]
+        blocks += [ir.Heading(1, '变量'), ir.Table(rows)]
+    blocks.append(ir.Heading(1, '操作步骤'))
+    for i, step in enumerate(steps, 1):
+        blocks.append(ir.NumberItem(describe(step), i))
+        if step['risk'] == 'high':
+            blocks.append(ir.Note(HIGH_RISK_NOTE, '高风险：'))
+    rows = [['#', 'ID', '操作', '目标', '风险']]
+    rows += [
+        [str(i), step['id'], ACTION_LABELS[step['action']], target_label(step.get('target')), RISK_LABELS[step['risk']]]
+        for i, step in enumerate(steps, 1)
+    ]
+    blocks += [ir.Heading(1, '步骤明细'), ir.Table(rows)]
+    return ir.Guide(blocks)
+
+
+def output_paths(src, src_dir, out_dir):
+    rel = src.relative_to(src_dir)
+    stem = rel.name[:-len(SUFFIX)]
+    base = Path(out_dir) / rel.parent
+    return base / f'{stem}.docx', base / f'{stem}.pdf'
+
+
+def compiler_key():
+    digest = hashlib.sha256(convert_first_use_pdf.compiler_key().encode('ascii'))
+    for name in SOURCES:
+        digest.update(Path(__file__).with_name(name).read_bytes())
+    return digest.digest()
+
+
+def render_workflow(job):
+    # Runs in a pool worker: the font and the ReportLab styles were set up
+    # once by init_worker.
+    src, docx_out, pdf_out, compact = job
+    try:
+        guide = guide_from_workflow(validate_workflow(json.loads(Path(src).read_text(encoding='utf-8'))))
+        docx_out.parent.mkdir(parents=True, exist_ok=True)
+        write_docx(guide.blocks, docx_out, guide.title, compact=compact)
+
+        def page_footer(canvas, doc):
+            draw_footer(canvas, doc.page, guide.title)
+
+        pdf = new_template(pdf_out, guide.title, compact)
+        with binary_streams(compact):
+            pdf.build(story_from_blocks(guide.blocks, convert_first_use_pdf.WORKER_STYLES), onFirstPage=page_footer, onLaterPages=page_footer)
+    except WorkflowError as e:
+        return f'{e.code}: {e}'
+    except Exception as e:
+        return f'{type(e).__name__}: {e}'
+    return None
+
+
+def build_all(src_dir, out_dir=None, workers=None, force=False, compact=False):
+    src_dir = Path(src_dir)
+    out_dir = Path(out_dir or src_dir)
+    manifest_path = out_dir / MANIFEST
+    previous = json.loads(manifest_path.read_text(encoding='utf-8')) if manifest_path.exists() else {}
+    # Switching --compact changes every output, so it is part of the key.
+    prefix = compiler_key() + (b'compact' if compact else b'')
+    manifest, pending, jobs = {}, {}, []
+    for src in sorted(src_dir.rglob(f'*{SUFFIX}')):
+        rel = src.relative_to(src_dir).as_posix()
+        digest = hashlib.sha256(prefix + src.read_bytes()).hexdigest()
+        docx_out, pdf_out = output_paths(src, src_dir, out_dir)
+        if not force and previous.get(rel) == digest and docx_out.exists() and pdf_out.exists():
+            manifest[rel] = digest
+            continue
+        pending[rel] = digest
+        jobs.append((src, docx_out, pdf_out, compact))
+    skipped = len(manifest)
+    workers = min(workers or os.cpu_count() or 1, max(len(jobs), 1))
+    start = time.perf_counter()
+    if workers == 1:
+        init_worker()
+        errors = list(map(render_workflow, jobs))
+    else:
+        # Finding the font here caches its path for the workers and reports
+        # a missing one as such instead of as a broken pool.
+        convert_first_use_pdf.register_font()
+        with ProcessPoolExecutor(workers, initializer=init_worker) as pool:
+            errors = list(pool.map(render_workflow, jobs, chunksize=max(1, len(jobs) // (workers * 4))))
+    elapsed = time.perf_counter() - start
+    failed = 0
+    for (src, _, _, _), error in zip(jobs, errors):
+        rel = src.relative_to(src_dir).as_posix()
+        if error:
+            failed += 1
+            print(f'{rel}: {error}')
+        else:
+            manifest[rel] = pending[rel]
+    out_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path.write_text(json.dumps(manifest, indent=2, sort_keys=True), encoding='utf-8')
+    rendered = len(jobs) - failed
+    rate = rendered / elapsed if elapsed else 0
+    print(f'{rendered} rendered, {skipped} unchanged, {failed} failed in {elapsed:.2f}s ({rate:.1f} docs/s, {workers} workers)')
+    return rendered, skipped, failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render every .smartpages.json workflow in a directory to DOCX and PDF.')
+    parser.add_argument('src_dir')
+    parser.add_argument('out_dir', nargs='?')
+    parser.add_argument('--workers', type=int, help='worker processes (default: one per CPU)')
+    parser.add_argument('--force', action='store_true', help='re-render inputs whose content hash is unchanged')
+    parser.add_argument('--compact', action='store_true', help='smaller DOCX and PDF output')
+    args = parser.parse_args()
+    try:
+        failed = build_all(args.src_dir, args.out_dir, args.workers, args.force, args.compact)[2]
+    except FontNotFoundError as e:
+        parser.exit(1, f'{e}\n')
+    sys.exit(1 if failed else 0)
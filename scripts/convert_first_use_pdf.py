@@ -1,24 +1,57 @@
+import argparse
+import hashlib
+import io
+import os
+import re
+import tempfile
+from contextlib import contextmanager
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from docx import Document
+from docx.enum.text import WD_ALIGN_PARAGRAPH
 from docx.table import Table
 from docx.text.paragraph import Paragraph
 from docx.oxml.table import CT_Tbl
 from docx.oxml.text.paragraph import CT_P
+from reportlab import rl_config
 from reportlab.lib import colors
 from reportlab.lib.enums import TA_CENTER, TA_LEFT
+from reportlab.lib.fonts import tt2ps
 from reportlab.lib.pagesizes import letter
 from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
 from reportlab.lib.units import inch
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.platypus import SimpleDocTemplate, Paragraph as RLParagraph, Spacer, Table as RLTable, TableStyle, KeepTogether
+from reportlab.pdfbase import pdfdoc, pdfmetrics
+from reportlab.pdfbase.pdfmetrics import registerFontFamily
+from reportlab.pdfgen.canvas import Canvas
+from reportlab.platypus import Flowable, SimpleDocTemplate, Image as RLImage, Paragraph as RLParagraph, Spacer, Table as RLTable, TableStyle, KeepTogether, PageBreak
 from reportlab.lib.colors import HexColor
 from xml.sax.saxutils import escape
+import docx_stream
+import guide_fingerprint
+import guide_ir as ir
+import pdf_fonts
+import pdf_layout
+import profiling
+from build_first_use_docx import DARK_BLUE, FOOTER, size_change
+from guide_images import ImageError, prepare_sections
+from guide_markdown import parse_sections
+from pdf_fonts import FontNotFoundError
+from pdf_layout import CachedParagraph, RunParagraph
 
 ROOT = Path(__file__).resolve().parents[1]
-SRC = ROOT / 'docs' / 'SmartPages-配置与首次使用.docx'
+SRC = ROOT / 'docs' / '配置与首次使用.md'
+DOCX_SRC = ROOT / 'docs' / 'SmartPages-配置与首次使用.docx'
 OUT = ROOT / 'docs' / 'SmartPages-配置与首次使用.pdf'
-FONT = r'C:\Windows\Fonts\msyh.ttc'
+FONT = os.environ.get('SMARTPAGES_PDF_FONT')
+BOLD_FONT = os.environ.get('SMARTPAGES_PDF_BOLD_FONT')
+# Standard PDF font for code blocks that are plain ASCII; anything else stays
+# in the CJK face.
+CODE_FONT = 'Courier'
+CODE_INDENT = re.compile(r'^ +')
+PLAIN, BOLD = (False, None, None), (True, None, None)
+LONG_TABLE_ROWS = 200
+TABLE_CHUNK_ROWS = 100
 
 
 def iter_blocks(parent):
@@ -30,88 +63,705 @@ def iter_blocks(parent):
             yield Table(child, parent)
 
 
-def footer(canvas, doc):
+def draw_footer(canvas, page, label):
     canvas.saveState()
     canvas.setFont('MSYH', 8)
     canvas.setFillColor(HexColor('#6B7280'))
-    canvas.drawRightString(letter[0] - inch, 0.55 * inch, f'SmartPages 配置与首次使用  |  {doc.page}')
+    canvas.drawRightString(letter[0] - inch, 0.55 * inch, f'{label}  |  {page}')
     canvas.restoreState()
 
 
 def cell_text(cell):
-    return '<br/>'.join(escape(p.text).replace('\n', '<br/>') for p in cell.paragraphs if p.text) or '&nbsp;'
+    return '\n'.join(p.text for p in cell.paragraphs if p.text)
 
 
-def build():
-    pdfmetrics.registerFont(TTFont('MSYH', FONT, subfontIndex=0))
+def markup(text):
+    return escape(text).replace('\n', '<br/>') or '&nbsp;'
+
+
+def code_markup(text):
+    # Paragraphs collapse spaces; keep each line's indentation.
+    return '<br/>'.join(CODE_INDENT.sub(lambda m: '&nbsp;' * len(m[0]), escape(line)) for line in text.split('\n')) or '&nbsp;'
+
+
+RUN_TAGS = {}
+
+
+def run_tags(bold, color, size):
+    # One (open, close) markup pair per formatting signature, shared by every
+    # run that has it.
+    key = (bold, color, size)
+    tags = RUN_TAGS.get(key)
+    if tags is None:
+        attrs = (f' color="#{color}"' if color else '') + (f' size="{size:g}"' if size else '')
+        tags = (f'<font{attrs}>', '</font>') if attrs else ('', '')
+        if bold:
+            tags = ('<b>' + tags[0], tags[1] + '</b>')
+        RUN_TAGS[key] = tags
+    return tags
+
+
+def block_parts(block, scale):
+    # (text, signature) of each formatted run. Run sizes are in DOCX points,
+    # relative to its body text.
+    if getattr(block, 'runs', ()):
+        return [(run.text, (run.bold, run.color, round(run.size * scale, 1) if run.size else None)) for run in block.runs]
+    if isinstance(block, ir.Text) and block.bold_prefix and block.text.startswith(block.bold_prefix):
+        return [(block.bold_prefix, BOLD), (block.text[len(block.bold_prefix):], PLAIN)]
+    return []
+
+
+def derived_style(styles, name, bold=False, color=None, size=None, font=None):
+    # Paragraphs whose runs all share one formatting get a style for it
+    # instead of markup. Styles are interned in the style sheet by their
+    # signature, so a document with any number of runs only ever creates a
+    # handful, and the layout cache hashes each one once.
+    key = (name, bold, color, size, font)
+    style = styles.get(key)
+    if style is None:
+        base = styles[name]
+        changes = {}
+        if font or bold:
+            changes['fontName'] = tt2ps(font or base.fontName, 1 if bold else 0, 0)
+        if color:
+            changes['textColor'] = HexColor(f'#{color}')
+        if size:
+            changes.update(fontSize=size, leading=base.leading * size / base.fontSize)
+        style = styles[key] = ParagraphStyle(f'{base.name}-{len(styles)}', parent=base, **changes)
+    return style
+
+
+def run_fragments(styles, style, signature):
+    # The text and line-break fragments ReportLab parses for a run with this
+    # formatting in this style. Parsed once per signature and cloned for
+    # every run, so paragraphs skip ReportLab's markup parser; the clones
+    # share the (empty, read-only) link and underline lists.
+    key = ('fragments', style.name, signature)
+    frags = styles.get(key)
+    if frags is None:
+        start, end = run_tags(*signature)
+        frags = styles[key] = RLParagraph(f'{start}x<br/>x{end}', style).frags[:2]
+    return frags
+
+
+def rich_paragraph(block, styles, name, **kwargs):
+    # The markup is still the paragraph's text, which keys the layout cache.
+    style = styles[name]
+    parts = block_parts(block, style.fontSize / docx_stream.BODY_SIZE)
+    signatures = {signature for _, signature in parts}
+    if len(signatures) < 2:
+        if signatures:
+            style = derived_style(styles, name, *signatures.pop())
+        parts = [(block.text, PLAIN)]
+        text = markup(block.text)
+    else:
+        text = ''.join(f'{tags[0]}{markup(part)}{tags[1]}' for part, tags in ((part, run_tags(*signature)) for part, signature in parts))
+    return RunParagraph(text, style, parts=[(part, run_fragments(styles, style, signature)) for part, signature in parts], **kwargs)
+
+
+def register_font():
+    if 'MSYH' not in pdfmetrics.getRegisteredFontNames():
+        path = FONT or pdf_fonts.find_cjk_font()
+        pdfmetrics.registerFont(pdf_fonts.load_font('MSYH', path))
+        bold = BOLD_FONT or pdf_fonts.find_bold_font(path)
+        if bold:
+            pdfmetrics.registerFont(pdf_fonts.load_font('MSYH-Bold', bold))
+        # Without a bold face, <b> falls back to the regular one.
+        bold = 'MSYH-Bold' if bold else 'MSYH'
+        registerFontFamily('MSYH', normal='MSYH', bold=bold, italic='MSYH', boldItalic=bold)
+
+
+def make_styles():
     styles = getSampleStyleSheet()
     base = dict(fontName='MSYH', fontSize=10.5, leading=16, textColor=HexColor('#1F2937'))
     body = ParagraphStyle('BodyCN', parent=styles['BodyText'], spaceAfter=7, **base)
-    bullet = ParagraphStyle('BulletCN', parent=body, leftIndent=18, firstLineIndent=-12, bulletIndent=0, spaceAfter=4)
-    number = ParagraphStyle('NumberCN', parent=body, leftIndent=22, firstLineIndent=-14, bulletIndent=0, spaceAfter=4)
-    h1 = ParagraphStyle('H1CN', parent=styles['Heading1'], fontName='MSYH', fontSize=16, leading=23, textColor=HexColor('#2E74B5'), spaceBefore=18, spaceAfter=9, keepWithNext=1)
-    h2 = ParagraphStyle('H2CN', parent=styles['Heading2'], fontName='MSYH', fontSize=13, leading=19, textColor=HexColor('#2E74B5'), spaceBefore=13, spaceAfter=6, keepWithNext=1)
-    title = ParagraphStyle('TitleCN', parent=styles['Title'], fontName='MSYH', fontSize=24, leading=30, textColor=HexColor('#1F4D78'), alignment=TA_CENTER, spaceAfter=4)
-    subtitle = ParagraphStyle('SubtitleCN', parent=body, fontSize=12, leading=18, textColor=HexColor('#5B6472'), alignment=TA_CENTER, spaceAfter=16)
     table_body = ParagraphStyle('TableBodyCN', parent=body, fontSize=8.8, leading=13, spaceAfter=0)
-    table_header = ParagraphStyle('TableHeaderCN', parent=table_body, textColor=HexColor('#1F4D78'))
-    docx = Document(SRC)
-    story = []
+    return {
+        'body': body,
+        'bullet': ParagraphStyle('BulletCN', parent=body, leftIndent=18, firstLineIndent=-12, bulletIndent=0, spaceAfter=4),
+        'number': ParagraphStyle('NumberCN', parent=body, leftIndent=22, firstLineIndent=-14, bulletIndent=0, spaceAfter=4),
+        'h1': ParagraphStyle('H1CN', parent=styles['Heading1'], fontName='MSYH', fontSize=16, leading=23, textColor=HexColor('#2E74B5'), spaceBefore=18, spaceAfter=9, keepWithNext=1),
+        'h2': ParagraphStyle('H2CN', parent=styles['Heading2'], fontName='MSYH', fontSize=13, leading=19, textColor=HexColor('#2E74B5'), spaceBefore=13, spaceAfter=6, keepWithNext=1),
+        'title': ParagraphStyle('TitleCN', parent=styles['Title'], fontName='MSYH', fontSize=24, leading=30, textColor=HexColor('#1F4D78'), alignment=TA_CENTER, spaceAfter=4),
+        'subtitle': ParagraphStyle('SubtitleCN', parent=body, fontSize=12, leading=18, textColor=HexColor('#5B6472'), alignment=TA_CENTER, spaceAfter=16),
+        'table_body': table_body,
+        'table_header': ParagraphStyle('TableHeaderCN', parent=table_body, textColor=HexColor('#1F4D78')),
+        'code': ParagraphStyle('CodeCN', parent=body, fontSize=9, leading=13, leftIndent=18, backColor=HexColor('#F4F6F9'), borderPadding=4, spaceBefore=4, spaceAfter=10),
+    }
+
+
+def blocks_from_docx(docx):
+    formats = docx_stream.character_formats(docx.styles.element)
     list_index = 0
     for block in iter_blocks(docx):
         if isinstance(block, Paragraph):
             text = block.text.strip()
             if not text:
                 continue
-            safe = escape(text).replace('\n', '<br/>')
             name = block.style.name
+            list_index = list_index + 1 if name == 'List Number' else 0
             if name == 'Heading 1':
-                story.append(RLParagraph(safe, h1))
+                yield ir.Heading(1, text)
             elif name == 'Heading 2':
-                story.append(RLParagraph(safe, h2))
+                yield ir.Heading(2, text)
             elif name == 'List Bullet':
-                story.append(RLParagraph(safe, bullet, bulletText='•'))
+                yield ir.Bullet(text, docx_stream.paragraph_runs(block._p, formats))
             elif name == 'List Number':
-                list_index += 1
-                story.append(RLParagraph(safe, number, bulletText=f'{list_index}.'))
+                yield ir.NumberItem(text, list_index, docx_stream.paragraph_runs(block._p, formats))
+            elif block.alignment == WD_ALIGN_PARAGRAPH.CENTER:
+                # The title and the subtitle are both centered; only the
+                # title is bold.
+                runs = block._p.r_lst
+                yield ir.Title(text) if runs and docx_stream.run_format(runs[0], formats)[0] else ir.Subtitle(text)
+            elif docx_stream.paragraph_indented(block._p):
+                yield ir.Code(text)
             else:
-                list_index = 0
-                if text == 'SmartPages 配置与首次使用':
-                    story.append(RLParagraph(safe, title))
-                elif text == '从安装、模型配置到首次生成文档':
-                    story.append(RLParagraph(safe, subtitle))
-                else:
-                    story.append(RLParagraph(safe, body))
+                yield docx_stream.text_block(text, docx_stream.run_parts(block._p, formats))
         else:
-            data = []
-            for row_i, row in enumerate(block.rows):
-                cells = []
-                for cell in row.cells:
-                    style = table_header if row_i == 0 else table_body
-                    cells.append(RLParagraph(cell_text(cell), style))
-                data.append(cells)
-            widths = [cell.width.inches * inch if cell.width else None for cell in block.rows[0].cells]
-            if not all(widths):
-                widths = None
-            table = RLTable(data, colWidths=widths, repeatRows=1, hAlign='LEFT')
-            ts = [
-                ('FONTNAME', (0, 0), (-1, -1), 'MSYH'),
-                ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-                ('LEFTPADDING', (0, 0), (-1, -1), 6), ('RIGHTPADDING', (0, 0), (-1, -1), 6),
-                ('TOPPADDING', (0, 0), (-1, -1), 5), ('BOTTOMPADDING', (0, 0), (-1, -1), 5),
-                ('GRID', (0, 0), (-1, -1), 0.35, HexColor('#C7D2E0')),
-                ('BACKGROUND', (0, 0), (-1, 0), HexColor('#E8EEF5')),
-            ]
-            if len(block.rows) == 1 and len(block.rows[0].cells) == 1:
-                ts += [('BACKGROUND', (0, 0), (-1, -1), HexColor('#F4F6F9'))]
-            table.setStyle(TableStyle(ts))
-            story.append(Spacer(1, 4))
-            story.append(table)
-            story.append(Spacer(1, 8))
-    pdf = SimpleDocTemplate(str(OUT), pagesize=letter, leftMargin=inch, rightMargin=inch, topMargin=inch, bottomMargin=0.8 * inch, title='SmartPages 配置与首次使用', author='SmartPages')
-    pdf.build(story, onFirstPage=footer, onLaterPages=footer)
-    print(OUT)
+            list_index = 0
+            rows = [[cell_text(cell) for cell in row.cells] for row in block.rows]
+            if len(rows) == 1 and len(rows[0]) == 1:
+                runs = block.rows[0].cells[0].paragraphs[0].runs
+                label = runs[0].text if runs and docx_stream.run_format(runs[0]._r, formats)[0] else None
+                yield ir.Note(rows[0][0][len(label or ''):], label)
+            else:
+                widths = [cell.width.twips if cell.width else None for cell in block.rows[0].cells]
+                yield ir.Table(rows, widths if all(widths) else None)
+
+
+def load_guide(src, keep_duplicates=False):
+    if Path(src).suffix.lower() == '.docx':
+        with profiling.span('pdf.docx_open'):
+            docx = Document(src)
+        with profiling.span('pdf.docx_blocks'):
+            return ir.Guide(list(blocks_from_docx(docx)), docx_stream.read_footer(src) or None)
+    with profiling.span('pdf.parse'):
+        sections = parse_sections(Path(src).read_text(encoding='utf-8'))
+    with profiling.span('pdf.images'):
+        sections = prepare_sections(sections, Path(src).parent, src=src, keep_duplicates=keep_duplicates)
+    return ir.Guide([block for section in sections for block in section.blocks])
+
+
+class TableChunk(Flowable):
+    # Rows of a long table after its first chunk. The header row is repeated
+    # only where they start a frame; right under the chunk before them they
+    # carry on without it. Each piece a split leaves over decides again.
+    def __init__(self, header, rows, col_widths, style, headless_style):
+        super().__init__()
+        self.header, self.rows = header, rows
+        self.col_widths, self.style, self.headless_style = col_widths, style, headless_style
+        self.table = self.headed = None
+
+    def make_table(self):
+        frame = getattr(self, '_frame', None)
+        self.headed = frame is None or frame._atTop
+        table = RLTable(self.header + self.rows if self.headed else self.rows, colWidths=self.col_widths, repeatRows=1 if self.headed else 0, hAlign='LEFT')
+        table.setStyle(self.style if self.headed else self.headless_style)
+        return table
+
+    def wrap(self, availWidth, availHeight):
+        self.table = self.make_table()
+        return self.table.wrap(availWidth, availHeight)
+
+    def drawOn(self, canvas, x, y, _sW=0):
+        self.table.drawOn(canvas, x, y, _sW)
+
+    def split(self, availWidth, availHeight):
+        table = self.make_table()
+        parts = table.split(availWidth, availHeight)
+        if not parts:
+            return []
+        done = len(parts[0]._cellvalues) - (len(self.header) if self.headed else 0)
+        return [parts[0], TableChunk(self.header, self.rows[done:], self.col_widths, self.style, self.headless_style)]
+
+
+def table_flowables(rows, widths, styles, note=False):
+    # Cells are given as paragraph markup.
+    data = []
+    for row_i, row in enumerate(rows):
+        style = styles['table_header'] if row_i == 0 and not note else styles['table_body']
+        data.append([CachedParagraph(text, style) for text in row])
+    body = [
+        ('FONTNAME', (0, 0), (-1, -1), 'MSYH'),
+        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+        ('LEFTPADDING', (0, 0), (-1, -1), 6), ('RIGHTPADDING', (0, 0), (-1, -1), 6),
+        ('TOPPADDING', (0, 0), (-1, -1), 5), ('BOTTOMPADDING', (0, 0), (-1, -1), 5),
+        ('GRID', (0, 0), (-1, -1), 0.35, HexColor('#C7D2E0')),
+    ]
+    ts = body + [('BACKGROUND', (0, 0), (-1, 0), HexColor('#E8EEF5'))]
+    if note:
+        ts += [('BACKGROUND', (0, 0), (-1, -1), HexColor('#F4F6F9'))]
+    table_style = TableStyle(ts)
+    col_widths = [w / 20 for w in widths]
+    table = RLTable(data[:TABLE_CHUNK_ROWS + 1] if len(data) > LONG_TABLE_ROWS else data, colWidths=col_widths, repeatRows=1, hAlign='LEFT')
+    table.setStyle(table_style)
+    tables = [table]
+    if len(data) > LONG_TABLE_ROWS:
+        # Splitting a Table across a page re-measures every remaining row, so
+        # one tall table lays out in quadratic time. Fixed-size chunks keep
+        # every split bounded.
+        headless_style = TableStyle(body)
+        tables += [TableChunk(data[:1], data[i:i + TABLE_CHUNK_ROWS], col_widths, table_style, headless_style)
+                   for i in range(TABLE_CHUNK_ROWS + 1, len(data), TABLE_CHUNK_ROWS)]
+    return [Spacer(1, 4), *tables, Spacer(1, 8)]
+
+
+class StreamingStory(list):
+    # SimpleDocTemplate consumes flowables from the front of a list. Keep only
+    # a short lookahead buffered (enough for keepWithNext chains) and pull the
+    # rest from the generator as the layout loop asks for it.
+    def __init__(self, flowables, lookahead=64):
+        super().__init__()
+        self.source = iter(flowables)
+        self.lookahead = lookahead
+
+    def __len__(self):
+        while self.source is not None and list.__len__(self) < self.lookahead:
+            try:
+                self.append(next(self.source))
+            except StopIteration:
+                self.source = None
+        return list.__len__(self)
+
+
+def iter_story(blocks, styles):
+    for block in blocks:
+        story = []
+        if isinstance(block, ir.Title):
+            story.append(rich_paragraph(block, styles, 'title'))
+        elif isinstance(block, ir.Subtitle):
+            story.append(rich_paragraph(block, styles, 'subtitle'))
+        elif isinstance(block, ir.Heading):
+            story.append(rich_paragraph(block, styles, 'h1' if block.level == 1 else 'h2'))
+        elif isinstance(block, ir.Bullet):
+            story.append(rich_paragraph(block, styles, 'bullet', bulletText='•'))
+        elif isinstance(block, ir.NumberItem):
+            story.append(rich_paragraph(block, styles, 'number', bulletText=f'{block.index}.'))
+        elif isinstance(block, ir.Note):
+            start, end = run_tags(True, DARK_BLUE, None)
+            story += table_flowables([[f'{start}{markup(block.label or "重要提示：")}{end}{markup(block.text)}']], [9360], styles, note=True)
+        elif isinstance(block, ir.Table):
+            story += table_flowables([[markup(text) for text in row] for row in block.rows], block.column_widths(), styles)
+        elif isinstance(block, ir.Code):
+            style = derived_style(styles, 'code', font=CODE_FONT) if block.text.isascii() else styles['code']
+            story.append(CachedParagraph(code_markup(block.text), style))
+        elif isinstance(block, ir.Image):
+            # drawImage names the XObject after the image data, so every
+            # step showing the same screenshot reuses one embedded copy.
+            story += [RLImage(block.path, block.width, block.height), Spacer(1, 8)]
+        else:
+            story.append(rich_paragraph(block, styles, 'body'))
+        yield from story
+
+
+def story_from_blocks(blocks, styles):
+    return list(iter_story(blocks, styles))
+
+
+def split_sections(blocks):
+    sections = [[]]
+    for block in blocks:
+        if isinstance(block, ir.Heading) and block.level == 1 and sections[-1]:
+            sections.append([])
+        sections[-1].append(block)
+    return sections
+
+
+def iter_section_story(sections, styles):
+    for i, blocks in enumerate(sections):
+        if i:
+            yield PageBreak()
+        yield from iter_story(blocks, styles)
+
+
+class BuildInfo(pdfdoc.PDFInfo):
+    # The document info plus entries of the builder's own, so Creator and
+    # Keywords keep their usual meaning.
+    def __init__(self, entries):
+        super().__init__()
+        self.entries = entries
+
+    def format(self, document):
+        info = super().format(document)
+        extra = pdfdoc.PDFDictionary({name: pdfdoc.PDFString(value) for name, value in self.entries.items()}).format(document)
+        # Both are << >> dictionaries; the entries go in before the end.
+        return info[:info.rindex(b'>>')] + extra[extra.index(b'<<') + 2:]
+
+
+class GuideCanvas(Canvas):
+    # SimpleDocTemplate writes the file from Canvas.save at the end of build;
+    # timing it separately splits serialization out of the layout span. info
+    # holds the digests guide_fingerprint reads back.
+    def __init__(self, *args, info=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if info:
+            self._doc.info = BuildInfo(info)
+
+    def save(self):
+        with profiling.span('pdf.serialize'):
+            super().save()
+
+
+class SpooledObject(pdfdoc.PDFObject):
+    # An object formatted when its page was finished and read back from the
+    # spool file while the PDF is written.
+    __RefOnly__ = 1
+
+    def __init__(self, spool, data):
+        self.spool = spool
+        self.offset = spool.seek(0, os.SEEK_END)
+        self.length = spool.write(data)
+
+    def format(self, document):
+        document.write_through()
+        self.spool.seek(self.offset)
+        return self.spool.read(self.length)
+
+
+class SpooledDocument(pdfdoc.PDFDocument):
+    # ReportLab keeps every page until save and then builds the file as one
+    # bytes object, so memory grows with the page count. This document
+    # formats each page and its content stream into a temporary file as soon
+    # as the page is finished (the page only refers to fonts, images and its
+    # parent by name), and writes the PDF to its output as it is formatted.
+    spool = None
+    out = None
+
+    def spool_page(self):
+        page = self.Pages.pages[-1]
+        stream = pdfdoc.PDFStream(content=page.stream)
+        if page.compression:
+            stream.filters = [pdfdoc.PDFBase85Encode, pdfdoc.PDFZCompress] if rl_config.useA85 else [pdfdoc.PDFZCompress]
+        page.Contents = SpooledObject(self.spool, stream.format(self))
+        spooled = SpooledObject(self.spool, page.format(self))
+        spooled.__InternalName__ = name = page.__InternalName__
+        self.idToObject[name] = self.Pages.pages[-1] = spooled
+
+    def write_through(self):
+        # format() hands the output collector to the objects it formats as
+        # __accum__; from the first spooled object on it writes to the file.
+        accum = self.__accum__
+        if accum.strings:
+            self.out.write(b''.join(accum.strings))
+            accum.strings.clear()
+            accum.write = self.out.write
+
+    def SaveToFile(self, filename, canvas):
+        try:
+            with open(filename, 'wb') as out:
+                self.out = out
+                super().SaveToFile(out, canvas)
+        finally:
+            self.out = None
+            self.spool.close()
+
+
+class SpooledCanvas(GuideCanvas):
+    # Keeps streamed builds flat; see SpooledDocument.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Canvas always creates a plain PDFDocument, which the spooled one
+        # only extends.
+        self._doc.__class__ = SpooledDocument
+        self._doc.spool = tempfile.TemporaryFile()
+
+    def showPage(self):
+        super().showPage()
+        self._doc.spool_page()
+
+
+def new_template(out, title, compact=False):
+    options = {'pageCompression': 1} if compact else {}
+    return SimpleDocTemplate(str(out), pagesize=letter, leftMargin=inch, rightMargin=inch, topMargin=inch, bottomMargin=0.8 * inch, title=title, author='SmartPages', **options)
+
+
+def compiler_key():
+    # Everything that decides how a guide is laid out.
+    digest = hashlib.sha256()
+    for name in ('convert_first_use_pdf.py', 'pdf_layout.py', 'pdf_fonts.py', 'guide_ir.py', 'guide_markdown.py', 'guide_images.py'):
+        digest.update(Path(__file__).with_name(name).read_bytes())
+    return digest.hexdigest()
+
+
+def generator_key(section_breaks=False):
+    # Page breaks are not part of the fingerprint, so output with a page
+    # break before every Heading 1 records a generator of its own.
+    key = compiler_key()[:12]
+    return f'{key}+sections' if section_breaks else key
+
+
+@contextmanager
+def binary_streams(enabled=True):
+    # ReportLab wraps every Flate stream (pages, images) in ASCII85 by
+    # default, which costs a quarter of their size. The embedded font is
+    # already a Flate-compressed subset of the glyphs used.
+    previous = rl_config.useA85
+    if enabled:
+        rl_config.useA85 = 0
+    try:
+        yield
+    finally:
+        rl_config.useA85 = previous
+
+
+def build(src=SRC, out=OUT, guide=None, stream=False, section_breaks=False, styles=None, layout_cache=True, compact=False, force=False, footer=None, keep_duplicates=False):
+    # Like the DOCX builder: the title falls back to the source name and the
+    # footer label to the title.
+    generator = generator_key(section_breaks)
+    if guide is None and stream and Path(src).suffix.lower() == '.docx':
+        title = docx_stream.read_title(src) or Path(src).stem
+        footer = footer or docx_stream.read_footer(src) or title
+        blocks = docx_stream.iter_blocks(src, runs=True)
+        # The blocks are read as they are laid out, so there is nothing to
+        # digest beforehand.
+        source = None
+    else:
+        if guide is None:
+            guide = load_guide(src, keep_duplicates)
+        title = guide.title or Path(src).stem
+        footer = footer or guide.footer or title
+        blocks = guide.blocks
+        source = guide_fingerprint.blocks_digest(blocks)
+        if not force:
+            with profiling.span('pdf.fingerprint'):
+                stale = guide_fingerprint.pdf_diff(out, blocks, title, footer, compact, generator)
+            if not stale:
+                print(f'{out} (up to date)')
+                return None
+    with profiling.span('pdf.font'):
+        register_font()
+    if styles is None:
+        with profiling.span('pdf.styles'):
+            styles = make_styles()
+    # Streamed stories are built lazily, so their block reading and flowable
+    # construction is part of the layout span; their pages are spooled to
+    # disk as they are finished.
+    canvas = SpooledCanvas
+    if section_breaks:
+        story = StreamingStory(profiling.counted('pdf.flowables', iter_section_story(split_sections(blocks), styles)))
+    elif stream:
+        story = StreamingStory(profiling.counted('pdf.flowables', iter_story(blocks, styles)))
+    else:
+        with profiling.span('pdf.story'):
+            story = story_from_blocks(blocks, styles)
+        profiling.count('pdf.flowables', len(story))
+        canvas = GuideCanvas
+    pdf = new_template(out, title, compact)
+    info = {guide_fingerprint.GENERATOR: generator}
+    if source:
+        info[guide_fingerprint.SOURCE] = source
+
+    def page_footer(canvas, doc):
+        draw_footer(canvas, doc.page, footer)
+
+    cache = CachedParagraph.cache = pdf_layout.cache_for(out) if layout_cache else None
+    before = Path(out).stat().st_size if compact and Path(out).exists() else None
+    try:
+        with profiling.span('pdf.layout'), binary_streams(compact):
+            pdf.build(story, onFirstPage=page_footer, onLaterPages=page_footer, canvasmaker=partial(canvas, info=info))
+    finally:
+        CachedParagraph.cache = None
+    if profiling.ENABLED:
+        profiling.count('pdf.pages', pdf.page)
+        profiling.count('pdf.bytes_written', Path(out).stat().st_size)
+    if cache is None:
+        print(out)
+    else:
+        cache.save()
+        profiling.count('pdf.layout_cache_hits', cache.hits)
+        profiling.count('pdf.layout_cache_misses', cache.misses)
+        print(f'{out} ({cache.summary()})')
+    if compact:
+        print(f'  compact pdf: {size_change(before, Path(out).stat().st_size)}')
+    return pdf.page
+
+
+WORKER_STYLES = None
+
+
+def init_worker():
+    global WORKER_STYLES
+    register_font()
+    WORKER_STYLES = make_styles()
+
+
+def block_texts(block):
+    # The text each block draws, as iter_story lays it out.
+    if isinstance(block, ir.Image):
+        return []
+    if isinstance(block, ir.Table):
+        return [cell for row in block.rows for cell in row]
+    texts = [block.text, *(run.text for run in getattr(block, 'runs', ()))]
+    if isinstance(block, ir.NumberItem):
+        texts.append(f'{block.index}.')
+    return texts
+
+
+def font_seeds(blocks, label):
+    # The characters each TrueType face may draw: the regular face any text
+    # of the guide and its footer, the bold face bold runs and note labels.
+    regular = set(f'{label}  |  0123456789')
+    bold = set()
+    for block in blocks:
+        for text in block_texts(block):
+            regular.update(text)
+        if isinstance(block, ir.Note):
+            bold.update(block.label or '重要提示：')
+        elif isinstance(block, ir.Text) and block.bold_prefix:
+            bold.update(block.bold_prefix)
+        for run in getattr(block, 'runs', ()):
+            if run.bold:
+                bold.update(run.text)
+    return {'MSYH': ''.join(sorted(regular)), 'MSYH-Bold': ''.join(sorted(bold))}
+
+
+def seed_fonts(canvas, seeds):
+    # Codes are handed out to characters in the order they are first drawn,
+    # so every batch would embed subsets of its own. Assigning all of them
+    # the same codes up front makes those subsets byte-identical, and the
+    # merge keeps one copy of each.
+    for name, chars in seeds.items():
+        if name in pdfmetrics.getRegisteredFontNames():
+            pdfmetrics.getFont(name).splitString(chars, canvas._doc)
+
+
+def render_batch(job):
+    sections, out, seeds = job
+    pdf = new_template(out, '')
+    pdf.build(StreamingStory(iter_section_story(sections, WORKER_STYLES)), onFirstPage=lambda canvas, doc: seed_fonts(canvas, seeds))
+    return pdf.page
+
+
+def batch_sections(sections, count):
+    # Contiguous runs of roughly equal block counts, so one huge section does
+    # not leave the other workers idle behind a queue of tiny ones.
+    target = max(1, sum(map(len, sections)) // count)
+    batches, size = [[]], 0
+    for section in sections:
+        if size >= target:
+            batches.append([])
+            size = 0
+        batches[-1].append(section)
+        size += len(section)
+    return batches
+
+
+def footer_overlay(pages, label, seeds):
+    # One page per output page carrying just its footer.
+    register_font()
+    buffer = io.BytesIO()
+    canvas = Canvas(buffer, pagesize=letter)
+    seed_fonts(canvas, seeds)
+    for page in range(1, pages + 1):
+        draw_footer(canvas, page, label)
+        canvas.showPage()
+    canvas.save()
+    buffer.seek(0)
+    return buffer
+
+
+def stamp_footers(writer, label, seeds):
+    # Each footer goes in as a content stream of its own ahead of the page's,
+    # which is where build() draws it. Its fonts are added under names of
+    # their own, so, unlike PageObject.merge_page, nothing of the page itself
+    # is parsed or rewritten.
+    from pypdf import PdfReader
+    from pypdf.generic import ArrayObject, DecodedStreamObject, NameObject
+    overlay = PdfReader(footer_overlay(len(writer.pages), label, seeds))
+    for page, stamp in zip(writer.pages, overlay.pages):
+        fonts = page['/Resources']['/Font']
+        code = stamp.get_contents().get_data()
+        for name, font in stamp['/Resources']['/Font'].items():
+            renamed = f'/Footer{name[1:]}'
+            fonts[NameObject(renamed)] = font.clone(writer)
+            code = code.replace(f'{name} '.encode(), f'{renamed} '.encode())
+        footer = DecodedStreamObject()
+        footer.set_data(code)
+        # With /Contents still set, replace_contents would store the array
+        # in place of the page's own stream.
+        contents = page['/Contents'].get_object()
+        del page['/Contents']
+        page.replace_contents(ArrayObject([footer, contents]))
+
+
+def build_parallel(src=SRC, out=OUT, guide=None, workers=None, footer=None, force=False, keep_duplicates=False):
+    # Every "Heading 1" section starts on a new page, so each batch of
+    # sections lays out the same way on its own and the merged result matches
+    # build(section_breaks=True). Footers sit below the frame, so batches are
+    # rendered once without them and the page numbers are stamped on while
+    # merging. One batch per worker keeps the number of embedded font subsets
+    # down.
+    from pypdf import PdfWriter
+    if guide is None:
+        guide = load_guide(src, keep_duplicates)
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        return build(src, out, guide=guide, section_breaks=True, footer=footer, force=force)
+    title = guide.title or Path(src).stem
+    label = footer or guide.footer or title
+    generator = generator_key(section_breaks=True)
+    source = guide_fingerprint.blocks_digest(guide.blocks)
+    if not force:
+        with profiling.span('pdf.fingerprint'):
+            stale = guide_fingerprint.pdf_diff(out, guide.blocks, title, label, False, generator)
+        if not stale:
+            print(f'{out} (up to date)')
+            return None
+    batches = batch_sections(split_sections(guide.blocks), workers)
+    seeds = font_seeds(guide.blocks, label)
+    # Finding the font here caches its path for the workers and reports a
+    # missing one as such instead of as a broken pool.
+    register_font()
+    with tempfile.TemporaryDirectory() as tmp:
+        paths = [Path(tmp) / f'{i}.pdf' for i in range(len(batches))]
+        with ProcessPoolExecutor(workers, initializer=init_worker) as pool:
+            with profiling.span('pdf.parallel.render'):
+                pages = sum(pool.map(render_batch, [(batch, path, seeds) for batch, path in zip(batches, paths)]))
+        with profiling.span('pdf.merge'):
+            writer = PdfWriter()
+            for path in paths:
+                writer.append(str(path))
+            stamp_footers(writer, label, seeds)
+            # Each pass merges objects that only differed in references the
+            # one before merged: the font files, their descriptors, the fonts.
+            for _ in range(3):
+                writer.compress_identical_objects()
+            writer.add_metadata({
+                '/Title': title,
+                '/Author': 'SmartPages',
+                f'/{guide_fingerprint.GENERATOR}': generator,
+                f'/{guide_fingerprint.SOURCE}': source,
+            })
+            with open(out, 'wb') as f:
+                writer.write(f)
+    if profiling.ENABLED:
+        profiling.count('pdf.pages', pages)
+        profiling.count('pdf.bytes_written', Path(out).stat().st_size)
+    print(out)
+    return pages
 
 
 if __name__ == '__main__':
-    build()
+    parser = argparse.ArgumentParser(description='Render the first-use guide (Markdown or DOCX) to PDF.')
+    parser.add_argument('src', nargs='?', default=SRC)
+    parser.add_argument('out', nargs='?', default=OUT)
+    parser.add_argument('--stream', action='store_true', help='read DOCX input incrementally')
+    parser.add_argument('--section-breaks', action='store_true', help='start every Heading 1 on a new page')
+    parser.add_argument('--parallel', type=int, nargs='?', const=0, metavar='WORKERS', help='lay out sections in a process pool (implies --section-breaks)')
+    parser.add_argument('--no-layout-cache', action='store_true', help='wrap every paragraph from scratch')
+    parser.add_argument('--compact', action='store_true', help='write binary (not ASCII85) compressed streams')
+    parser.add_argument('--force', action='store_true', help='rewrite the PDF even if it is up to date')
+    parser.add_argument('--keep-duplicates', action='store_true', help='keep consecutive screenshots with the same pixels')
+    parser.add_argument('--profile', metavar='REPORT', help='write a JSON timing report')
+    parser.add_argument('--cprofile', metavar='STATS', help='write a cProfile dump')
+    args = parser.parse_args()
+    try:
+        with profiling.session('convert_first_use_pdf', args.profile, args.cprofile):
+            # The checked-in Markdown guide keeps its own footer label.
+            footer = FOOTER if Path(args.src) == SRC else None
+            if args.parallel is not None:
+                build_parallel(args.src, args.out, workers=args.parallel or None, footer=footer, force=args.force, keep_duplicates=args.keep_duplicates)
+            else:
+                build(args.src, args.out, stream=args.stream, section_breaks=args.section_breaks, layout_cache=not args.no_layout_cache, compact=args.compact, force=args.force, footer=footer, keep_duplicates=args.keep_duplicates)
+    except (FontNotFoundError, ImageError) as e:
+        parser.exit(1, f'{e}\n')
@@ -0,0 +1,376 @@
+import dataclasses
+import re
+import zipfile
+from io import BytesIO
+from xml.sax.saxutils import escape
+from docx import Document
+from docx.opc.oxml import serialize_part_xml
+from lxml import etree
+import guide_ir as ir
+from build_first_use_docx import COMPRESS_LEVEL, CUSTOM_PROPERTIES, PARAGRAPH_FORMATS, body_content, compact_formats, compact_formatting, emit, setup
+
+W = 'http://schemas.openxmlformats.org/wordprocessingml/2006/main'
+DC = 'http://purl.org/dc/elements/1.1/'
+A_BLIP = '{http://schemas.openxmlformats.org/drawingml/2006/main}blip'
+R_EMBED = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}embed'
+REL = '{http://schemas.openxmlformats.org/package/2006/relationships}Relationship'
+
+
+def w(tag):
+    return f'{{{W}}}{tag}'
+
+
+W_BODY, W_P, W_TBL, W_TR, W_TC, W_R = w('body'), w('p'), w('tbl'), w('tr'), w('tc'), w('r')
+W_T, W_TAB, W_BR, W_CR = w('t'), w('tab'), w('br'), w('cr')
+W_VAL = w('val')
+W_RPR, W_RSTYLE, W_B, W_COLOR, W_SZ = w('rPr'), w('rStyle'), w('b'), w('color'), w('sz')
+# The size the builder gives body text; runs at this size add nothing.
+BODY_SIZE = PARAGRAPH_FORMATS['Normal'][0][0]
+PLAIN, BOLD = (False, None, None), (True, None, None)
+
+NS_DECL = re.compile(r'\sxmlns:\w+="[^"]*"')
+SLOT = re.compile(r'<w:t>(SMARTPAGES_SLOT_[01])</w:t>')
+
+
+def core_title(zf):
+    try:
+        root = etree.fromstring(zf.read('docProps/core.xml'))
+    except KeyError:
+        return None
+    node = root.find(f'{{{DC}}}title')
+    return node.text if node is not None else None
+
+
+def custom_properties(zf):
+    try:
+        root = etree.fromstring(zf.read('docProps/custom.xml'))
+    except KeyError:
+        return {}
+    return {prop.get('name'): ''.join(prop.itertext()) for prop in root.iter(f'{{{CUSTOM_PROPERTIES}}}property')}
+
+
+def image_parts(zf):
+    # Relationship id -> zip member for every picture the body refers to.
+    try:
+        root = etree.fromstring(zf.read('word/_rels/document.xml.rels'))
+    except KeyError:
+        return {}
+    return {
+        rel.get('Id'): 'word/' + rel.get('Target')
+        for rel in root.iter(REL)
+        if rel.get('Type', '').endswith('/image') and rel.get('TargetMode') != 'External'
+    }
+
+
+def style_names(zf):
+    try:
+        root = etree.fromstring(zf.read('word/styles.xml'))
+    except KeyError:
+        return {}
+    names = {}
+    for style in root.iter(w('style')):
+        name = style.find(w('name'))
+        if name is not None:
+            names[style.get(w('styleId'))] = name.get(W_VAL).lower()
+    return names
+
+
+def run_formats(zf):
+    try:
+        return character_formats(etree.fromstring(zf.read('word/styles.xml')))
+    except KeyError:
+        return {}
+
+
+def character_formats(root):
+    # (bold, color, size) of every character style; compact documents keep
+    # run formatting in these rather than in each run.
+    return {
+        style.get(w('styleId')): rpr_format(style.find(w('rPr')))
+        for style in root.iter(w('style')) if style.get(w('type')) == 'character'
+    }
+
+
+def rpr_format(rpr, base=(None, None, None), formats=None):
+    # With formats, a w:rStyle in rpr swaps base for that character style's
+    # format; the run's own properties override either.
+    bold = color = size = style = None
+    if rpr is not None:
+        for node in rpr:
+            tag = node.tag
+            if tag == W_B:
+                bold = node.get(W_VAL) not in ('0', 'false')
+            elif tag == W_COLOR and node.get(W_VAL) != 'auto':
+                color = node.get(W_VAL)
+            elif tag == W_SZ:
+                size = int(node.get(W_VAL)) / 2
+            elif tag == W_RSTYLE:
+                style = node.get(W_VAL)
+    if style is not None and formats is not None:
+        base = formats.get(style, base)
+    return base[0] if bold is None else bold, base[1] if color is None else color, base[2] if size is None else size
+
+
+def paragraph_text(p):
+    parts = []
+    for node in p.iter(W_T, W_TAB, W_BR, W_CR):
+        if node.tag == W_T:
+            parts.append(node.text or '')
+        elif node.tag == W_TAB:
+            parts.append('\t')
+        else:
+            parts.append('\n')
+    return ''.join(parts)
+
+
+def paragraph_style(p):
+    node = p.find(f'{w("pPr")}/{w("pStyle")}')
+    return node.get(W_VAL) if node is not None else None
+
+
+def paragraph_centered(p):
+    node = p.find(f'{w("pPr")}/{w("jc")}')
+    return node is not None and node.get(W_VAL) == 'center'
+
+
+def paragraph_indented(p):
+    return p.find(f'{w("pPr")}/{w("ind")}') is not None
+
+
+def run_format(r, formats):
+    return rpr_format(r.find(W_RPR), formats=formats)
+
+
+def run_parts(p, formats):
+    # (text, (bold, color, size)) of every run with text, keeping only what
+    # differs from plain body text. Every run, as paragraph_text reads them:
+    # runs inside w:hyperlink, w:ins, w:smartTag and w:fldSimple are not
+    # children of the paragraph.
+    parts = []
+    for r in p.iter(W_R):
+        rpr = None
+        texts = []
+        for node in r:
+            tag = node.tag
+            if tag == W_T:
+                texts.append(node.text or '')
+            elif tag == W_RPR:
+                rpr = node
+            elif tag == W_TAB:
+                texts.append('\t')
+            elif tag == W_BR or tag == W_CR:
+                texts.append('\n')
+        text = ''.join(texts)
+        if text and rpr is None:
+            parts.append((text, PLAIN))
+        elif text:
+            bold, color, size = rpr_format(rpr, PLAIN, formats)
+            parts.append((text, (bool(bold), color, size if size != BODY_SIZE else None)))
+    return parts
+
+
+def text_runs(parts):
+    # Runs of a body paragraph as IR runs; () when the paragraph has no
+    # formatting of its own.
+    if all(signature == PLAIN for _, signature in parts):
+        return ()
+    return tuple(ir.Run(text, *signature) for text, signature in parts)
+
+
+def paragraph_runs(p, formats):
+    return text_runs(run_parts(p, formats))
+
+
+def text_block(text, parts):
+    # A bold first run over plain ones is how the builder writes a bold
+    # prefix; read it back as one rather than as runs.
+    if len(parts) > 1 and parts[0][1] == BOLD and text.startswith(parts[0][0]) and all(signature == PLAIN for _, signature in parts[1:]):
+        return ir.Text(text, parts[0][0])
+    return ir.Text(text, runs=text_runs(parts))
+
+
+def table_block(tbl, formats):
+    rows = []
+    widths = []
+    for row_i, tr in enumerate(tbl.iterchildren(W_TR)):
+        cells = []
+        for tc in tr.iterchildren(W_TC):
+            cells.append('\n'.join(text for text in map(paragraph_text, tc.iterchildren(W_P)) if text))
+            if row_i == 0:
+                width = tc.find(f'{w("tcPr")}/{w("tcW")}')
+                widths.append(int(width.get(w('w'))) if width is not None and width.get(w('type')) == 'dxa' else None)
+        rows.append(cells)
+    if len(rows) == 1 and len(rows[0]) == 1:
+        first = tbl.find(f'{W_TR}/{W_TC}/{W_P}/{W_R}')
+        label = paragraph_text(first) if first is not None and run_format(first, formats)[0] else None
+        return ir.Note(rows[0][0][len(label or ''):], label)
+    return ir.Table(rows, widths if widths and all(widths) else None)
+
+
+def iter_blocks(src, images=False, runs=False):
+    # Walk word/document.xml with iterparse and drop every body child once it
+    # has been turned into a block, so memory stays bounded by the largest
+    # single paragraph or table rather than by the document. With images,
+    # picture paragraphs come back as Image blocks whose path is the media
+    # member inside the package; with runs, body text and list items carry
+    # their run formatting.
+    with zipfile.ZipFile(src) as zf:
+        names = style_names(zf)
+        formats = run_formats(zf)
+        parts = image_parts(zf) if images else {}
+        list_index = 0
+        with zf.open('word/document.xml') as stream:
+            for _, el in etree.iterparse(stream, events=('end',), tag=(W_P, W_TBL)):
+                parent = el.getparent()
+                if parent is None or parent.tag != W_BODY:
+                    continue
+                if el.tag == W_TBL:
+                    list_index = 0
+                    block = table_block(el, formats)
+                else:
+                    block = None
+                    # With runs, the paragraph's text is read from them.
+                    text_parts = run_parts(el, formats) if runs else None
+                    text = (''.join(part for part, _ in text_parts) if runs else paragraph_text(el)).strip()
+                    style_id = paragraph_style(el)
+                    name = names.get(style_id, (style_id or '').lower())
+                    if text:
+                        list_index = list_index + 1 if name == 'list number' else 0
+                        if name == 'heading 1':
+                            block = ir.Heading(1, text)
+                        elif name == 'heading 2':
+                            block = ir.Heading(2, text)
+                        elif name == 'list bullet':
+                            block = ir.Bullet(text, text_runs(text_parts) if runs else ())
+                        elif name == 'list number':
+                            block = ir.NumberItem(text, list_index, text_runs(text_parts) if runs else ())
+                        elif paragraph_centered(el):
+                            # The title and the subtitle are both centered;
+                            # only the title is bold.
+                            first = el.find(W_R)
+                            bold = first is not None and run_format(first, formats)[0]
+                            block = ir.Title(text) if bold else ir.Subtitle(text)
+                        elif paragraph_indented(el):
+                            block = ir.Code(text)
+                        else:
+                            block = text_block(text, text_parts) if runs else ir.Text(text)
+                    elif images:
+                        blip = next(el.iter(A_BLIP), None)
+                        if blip is not None and blip.get(R_EMBED) in parts:
+                            list_index = 0
+                            block = ir.Image(parts[blip.get(R_EMBED)])
+                el.clear()
+                while el.getprevious() is not None:
+                    del parent[0]
+                if block is not None:
+                    yield block
+
+
+def read_title(src):
+    with zipfile.ZipFile(src) as zf:
+        return core_title(zf)
+
+
+def footer_text(zf):
+    return ''.join(
+        paragraph_text(p)
+        for name in zf.namelist() if re.fullmatch(r'word/footer\d*\.xml', name)
+        for p in etree.fromstring(zf.read(name)).iter(W_P)
+    )
+
+
+def read_footer(src):
+    with zipfile.ZipFile(src) as zf:
+        return footer_text(zf)
+
+
+def fragment_xml(element):
+    # The document root already declares every namespace python-docx uses.
+    xml = etree.tostring(element, encoding='unicode')
+    head, rest = xml.split('>', 1)
+    return NS_DECL.sub('', head) + '>' + rest
+
+
+def run_text(text):
+    return '<w:br/>'.join(f'<w:t xml:space="preserve">{escape(part)}</w:t>' for part in text.split('\n'))
+
+
+class FragmentRenderer:
+    # Renders each kind of block once through the add_* helpers with
+    # placeholder text, then fills the cached XML for every later block of
+    # the same kind. Tables and pictures have no fixed shape and go through
+    # the helpers.
+    def __init__(self, footer='SmartPages 配置与首次使用', compact=False):
+        self.doc = Document()
+        setup(self.doc, footer=footer, compact=compact)
+        self.formats = compact_formats(self.doc.styles.element) if compact else None
+        self.templates = {}
+
+    def scratch(self, block):
+        body = self.doc.element.body
+        start = len(body_content(body))
+        emit(self.doc, block)
+        elements = body_content(body)[start:]
+        for element in elements:
+            body.remove(element)
+            if self.formats:
+                compact_formatting(element, self.formats)
+        return ''.join(fragment_xml(element) for element in elements)
+
+    def render(self, block):
+        if isinstance(block, (ir.Table, ir.Image)):
+            return self.scratch(block)
+        slots = {'SMARTPAGES_SLOT_0': block.text}
+        if isinstance(block, ir.Text) and block.bold_prefix and block.text.startswith(block.bold_prefix):
+            key = (ir.Text, True)
+            placeholder = ir.Text('SMARTPAGES_SLOT_1SMARTPAGES_SLOT_0', 'SMARTPAGES_SLOT_1')
+            slots = {'SMARTPAGES_SLOT_0': block.text[len(block.bold_prefix):], 'SMARTPAGES_SLOT_1': block.bold_prefix}
+        elif isinstance(block, ir.Note):
+            key = (ir.Note, block.label is not None)
+            placeholder = ir.Note('SMARTPAGES_SLOT_0', 'SMARTPAGES_SLOT_1' if block.label is not None else None)
+            slots['SMARTPAGES_SLOT_1'] = block.label
+        else:
+            key = (type(block), getattr(block, 'level', None))
+            placeholder = dataclasses.replace(block, text='SMARTPAGES_SLOT_0')
+            if isinstance(block, ir.Text):
+                placeholder = ir.Text('SMARTPAGES_SLOT_0')
+        parts = self.templates.get(key)
+        if parts is None:
+            parts = self.templates[key] = SLOT.split(self.scratch(placeholder))
+        return ''.join(run_text(slots[part]) if i % 2 else part for i, part in enumerate(parts))
+
+
+def write_docx(blocks, out, title, subject=None, footer=None, chunk_size=1 << 16, compact=False):
+    # The renderer's python-docx document doubles as the package: styles,
+    # numbering, footer and core properties match build(), and any picture
+    # it rendered is already related to its document part. The body is
+    # streamed into word/document.xml block by block, the remaining parts
+    # are copied in afterwards.
+    renderer = FragmentRenderer(footer or title, compact)
+    level = COMPRESS_LEVEL if compact else None
+    doc = renderer.doc
+    doc.core_properties.title = title
+    doc.core_properties.subject = subject or title
+    doc.core_properties.author = 'SmartPages'
+    xml = serialize_part_xml(doc.element).decode('utf-8')
+    split = xml.index('<w:sectPr')
+    with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED, compresslevel=level) as dst:
+        with dst.open('word/document.xml', 'w', force_zip64=True) as stream:
+            stream.write(xml[:split].encode('utf-8'))
+            chunk, size = [], 0
+            for block in blocks:
+                fragment = renderer.render(block)
+                chunk.append(fragment)
+                size += len(fragment)
+                if size >= chunk_size:
+                    stream.write(''.join(chunk).encode('utf-8'))
+                    chunk, size = [], 0
+            stream.write(''.join(chunk).encode('utf-8'))
+            stream.write(xml[split:].encode('utf-8'))
+        package = BytesIO()
+        doc.save(package)
+        with zipfile.ZipFile(package) as src:
+            for info in src.infolist():
+                if info.filename != 'word/document.xml':
+                    dst.writestr(info, src.read(info), compresslevel=level)
+    return out
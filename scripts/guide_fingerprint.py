@@ -0,0 +1,340 @@
+import argparse
+import dataclasses
+import difflib
+import hashlib
+import json
+import re
+import sys
+import time
+import zipfile
+from collections import namedtuple
+from pathlib import Path
+from PIL import Image as PILImage
+import guide_ir as ir
+from guide_images import ImageError, file_digest, pixel_digest, prepare_sections
+from guide_markdown import parse_sections
+
+NOTE_LABEL = '重要提示：'
+# What the PDF draws around block text: list bullets and numbers.
+PDF_NOISE = re.compile(r'(?:[•\x7f]|\d+\.)*')
+IMAGE_MARK = '\x1e'
+PDF_TOKEN = re.compile(
+    rb'\bBT\b|\bET\b|/(?P<font>[^\s/()<>\[\]]+)\s+[-\d.]+\s+Tf|\((?P<string>(?:\\.|[^\\)])*)\)\s*Tj|/(?P<xobject>[^\s/()<>\[\]]+)\s+Do',
+    re.S,
+)
+PDF_ESCAPE = re.compile(rb'\\([0-7]{1,3}|.)', re.S)
+PDF_ESCAPES = {b'n': b'\n', b'r': b'\r', b't': b'\t', b'b': b'\b', b'f': b'\f'}
+CMAP_BFCHAR = re.compile(rb'beginbfchar(.*?)endbfchar', re.S)
+CMAP_PAIR = re.compile(rb'<([0-9A-Fa-f]+)>\s*<([0-9A-Fa-f]+)>')
+# The builders record the generator and source digests under names of their
+# own: DOCX custom properties and PDF document info entries.
+GENERATOR = 'SmartpagesGenerator'
+SOURCE = 'SmartpagesSource'
+
+# One entry per block: a digest of its kind and whitespace-free text, so
+# re-wrapping, zip member order and timestamps never count as a change, and
+# a short label for the diff. Formatting cannot be read back from a PDF, so
+# the properties entry also carries a digest of the blocks themselves, which
+# each output stores when it is written.
+Entry = namedtuple('Entry', 'digest label')
+
+
+def clean(text):
+    return ''.join(text.split())
+
+
+def entry(kind, text, width=60):
+    # Code keeps its whitespace: indentation is part of what it shows.
+    digest = hashlib.sha256(f'{kind}\0{text.strip() if kind == "Code" else clean(text)}'.encode('utf-8')).hexdigest()[:16]
+    label = ' '.join(text.split())
+    return Entry(digest, f'{kind}: {label[:width]}…' if width and len(label) > width else f'{kind}: {label}')
+
+
+def block_forms(block):
+    # (kind, text) for each entry of a block as both backends show it: a
+    # note always starts with its label, and every table row is an entry of
+    # its own so a diff points at the row that changed.
+    if isinstance(block, ir.Table):
+        forms = [('Table', '\t'.join(block.rows[0]))] + [('Row', '\t'.join(row)) for row in block.rows[1:]]
+    elif isinstance(block, ir.Heading):
+        forms = [(f'Heading {block.level}', block.text)]
+    elif isinstance(block, ir.Note):
+        forms = [('Note', (block.label or NOTE_LABEL) + block.text)]
+    elif isinstance(block, (ir.Title, ir.Subtitle, ir.Bullet, ir.NumberItem, ir.Code)):
+        forms = [(type(block).__name__, block.text)]
+    else:
+        forms = [('Text', block.text)]
+    return [(kind, text) for kind, text in forms if clean(text)]
+
+
+def image_pixels(path):
+    # Processed images record their pixel digest next to them; older cache
+    # entries are filled in on first use.
+    meta = Path(path).with_suffix('.json')
+    try:
+        info = json.loads(meta.read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        info = None
+    if info and 'pixels' in info:
+        return info['pixels']
+    with PILImage.open(path) as img:
+        pixels = pixel_digest(img)
+    if info is not None:
+        info['pixels'] = pixels
+        meta.write_text(json.dumps(info), encoding='utf-8')
+    return pixels
+
+
+def block_fields(block):
+    # Everything the backends render from a block: runs, bold prefixes, list
+    # numbers, table widths and image sizes as well as the text. Images are
+    # identified by their samples; the processed copy's path is under this
+    # checkout's cache.
+    if isinstance(block, ir.Image):
+        return 'Image', image_pixels(block.path), block.alt, block.width, block.height
+    return (type(block).__name__, *dataclasses.astuple(block))
+
+
+def blocks_digest(blocks):
+    return hashlib.sha256(repr([block_fields(block) for block in blocks]).encode('utf-8')).hexdigest()[:16]
+
+
+def properties(**values):
+    return entry('Properties', ' '.join(f'{name}={value}' for name, value in values.items()), width=None)
+
+
+def source_entries(blocks, title, subject=None, footer=None, compact=False, generator=None):
+    # What build_first_use_docx.build writes for these blocks.
+    entries = [properties(
+        title=title, subject=subject or title, footer=footer or title, compact=compact, generator=generator, source=blocks_digest(blocks),
+    )]
+    for block in blocks:
+        if isinstance(block, ir.Image):
+            entries.append(entry('Image', file_digest(block.path)))
+        else:
+            entries += [entry(kind, text) for kind, text in block_forms(block)]
+    return entries
+
+
+def docx_entries(path):
+    # Streams the same iter_blocks walk the PDF converter uses, plus the
+    # bytes of every picture and the package properties.
+    import docx_stream
+    from lxml import etree
+    with zipfile.ZipFile(path) as zf:
+        core = etree.fromstring(zf.read('docProps/core.xml'))
+        subject = core.find(f'{{{docx_stream.DC}}}subject')
+        custom = docx_stream.custom_properties(zf)
+        footer = docx_stream.footer_text(zf)
+        compact = b'w:styleId="SPStrong"' in zf.read('word/styles.xml')
+        entries = [properties(
+            title=docx_stream.core_title(zf), subject=subject.text if subject is not None else None, footer=footer, compact=compact,
+            generator=custom.get(GENERATOR), source=custom.get(SOURCE),
+        )]
+        for block in docx_stream.iter_blocks(path, images=True):
+            if isinstance(block, ir.Image):
+                entries.append(entry('Image', hashlib.sha256(zf.read(block.path)).hexdigest()))
+            else:
+                entries += [entry(kind, text) for kind, text in block_forms(block)]
+    return entries
+
+
+def to_unicode(font):
+    # Code -> text from the font's ToUnicode CMap. ReportLab writes one
+    # bfchar entry per code of each 256-glyph subset; fonts without a CMap
+    # (the Helvetica used for bullets) are read as Latin-1.
+    cmap = font.get('/ToUnicode')
+    if cmap is None:
+        return None
+    table = {}
+    for block in CMAP_BFCHAR.findall(cmap.get_object().get_data()):
+        for code, text in CMAP_PAIR.findall(block):
+            table[int(code, 16)] = bytes.fromhex(text.decode('ascii')).decode('utf-16-be')
+    return table
+
+
+def unescape(raw):
+    return PDF_ESCAPE.sub(
+        lambda m: bytes([int(m[1], 8) & 0xff]) if m[1][0] in b'01234567' else PDF_ESCAPES.get(m[1], m[1]), raw,
+    )
+
+
+def pdf_stream(reader):
+    # Text and image draws of every page in content-stream order, without
+    # whitespace or the page footer, and the footer label. Images become a
+    # marker carrying the digest of their samples. This reads ReportLab's own
+    # output (Tf, Tj and Do inside BT/ET text objects) directly, which is an
+    # order of magnitude quicker than general text extraction.
+    parts = []
+    label = None
+    cmaps = {}
+    for number, page in enumerate(reader.pages, 1):
+        footer = re.compile(rf'\|\s*{number}\s*$')
+        resources = page.get('/Resources') or {}
+        fonts = resources.get('/Font') or {}
+        xobjects = resources.get('/XObject') or {}
+        table = None
+        text = None
+        for m in PDF_TOKEN.finditer(page.get_contents().get_data()):
+            if m[0] == b'BT':
+                text = []
+            elif m[0] == b'ET':
+                if text:
+                    line = ''.join(text)
+                    if not footer.search(line):
+                        parts.append(clean(line))
+                    elif label is None:
+                        label = footer.sub('', line).strip()
+                text = None
+            elif m['font']:
+                name = '/' + m['font'].decode('latin-1')
+                font = fonts[name].get_object() if name in fonts else {}
+                key = id(font)
+                if key not in cmaps:
+                    cmaps[key] = (font, to_unicode(font))
+                table = cmaps[key][1]
+            elif m['string'] is not None:
+                raw = unescape(m['string'])
+                decoded = raw.decode('latin-1') if table is None else ''.join(table.get(code, '') for code in raw)
+                if text is None:
+                    parts.append(clean(decoded))
+                else:
+                    text.append(decoded)
+            elif m['xobject']:
+                name = '/' + m['xobject'].decode('latin-1')
+                xobject = xobjects[name].get_object() if name in xobjects else {}
+                if xobject.get('/Subtype') == '/Image':
+                    parts.append(f'{IMAGE_MARK}{hashlib.sha256(xobject.get_data()).hexdigest()}{IMAGE_MARK}')
+    return ''.join(parts), label
+
+
+def pdf_units(blocks):
+    # (entry, drawn text, repeats allowed before it) in drawing order.
+    # ReportLab draws a table cell by cell, one row after the other, and
+    # repeats the header row on every page the table continues on.
+    for block in blocks:
+        if isinstance(block, ir.Image):
+            pixels = image_pixels(block.path)
+            yield entry('Image', pixels), f'{IMAGE_MARK}{pixels}{IMAGE_MARK}', ()
+            continue
+        header = ()
+        for kind, text in block_forms(block):
+            yield entry(kind, text), clean(text), header
+            if kind == 'Table':
+                header = (clean(text),)
+
+
+def pdf_source_entries(blocks, title, footer=None, compact=False, generator=None):
+    # What convert_first_use_pdf.build writes for these blocks.
+    entries = [properties(title=title, footer=footer or title, compact=compact, generator=generator, source=blocks_digest(blocks))]
+    return entries + [unit[0] for unit in pdf_units(blocks)]
+
+
+def pdf_entries(path, blocks):
+    # A PDF keeps no block structure, so the source entries are looked up in
+    # its text in order. Found entries are kept as they are; text between
+    # them that is not a bullet, a number or a repeated table header is
+    # reported as it stands.
+    from pypdf import PdfReader
+    reader = PdfReader(str(path))
+    # Parallel builds give every page its footer as a stream of its own.
+    contents = reader.pages[0].get('/Contents') if reader.pages else None
+    contents = contents.get_object() if contents is not None else []
+    filters = []
+    for stream in contents if isinstance(contents, list) else [contents]:
+        found = stream.get_object().get('/Filter', [])
+        filters += found if isinstance(found, list) else [found]
+    compact = '/ASCII85Decode' not in filters
+    info = reader.metadata or {}
+    stream, footer = pdf_stream(reader)
+    entries = [properties(
+        title=info.get('/Title'), footer=footer, compact=compact,
+        generator=info.get(f'/{GENERATOR}'), source=info.get(f'/{SOURCE}'),
+    )]
+    pos = 0
+
+    def skipped(gap, repeats=()):
+        for text in repeats:
+            gap = gap.replace(text, '')
+        for i, piece in enumerate(gap.split(IMAGE_MARK)):
+            if i % 2:
+                entries.append(entry('Image', piece))
+            elif piece and not PDF_NOISE.fullmatch(piece):
+                entries.append(entry('Text', piece))
+
+    for unit, text, repeats in pdf_units(blocks):
+        found = stream.find(text, pos)
+        if found >= 0:
+            skipped(stream[pos:found], repeats)
+            entries.append(unit)
+            pos = found + len(text)
+    skipped(stream[pos:])
+    return entries
+
+
+def diff(current, expected):
+    lines = []
+    matcher = difflib.SequenceMatcher(None, [e.digest for e in current], [e.digest for e in expected], autojunk=False)
+    for op, i1, i2, j1, j2 in matcher.get_opcodes():
+        if op != 'equal':
+            lines += [f'  - {e.label}' for e in current[i1:i2]]
+            lines += [f'  + {e.label}' for e in expected[j1:j2]]
+    return lines
+
+
+def load_blocks(src, keep_duplicates=False):
+    sections = parse_sections(Path(src).read_text(encoding='utf-8'))
+    sections = prepare_sections(sections, Path(src).parent, src=src, keep_duplicates=keep_duplicates)
+    return ir.Guide([block for section in sections for block in section.blocks])
+
+
+def check(out, expected, current_entries):
+    # Returns the diff lines, or [] when the output matches.
+    if not Path(out).exists():
+        return ['  (missing)']
+    try:
+        current = current_entries(out)
+    except Exception as e:
+        return [f'  (unreadable: {type(e).__name__}: {e})']
+    return diff(current, expected) if current != expected else []
+
+
+def docx_diff(out, blocks, title, subject=None, footer=None, compact=False, generator=None):
+    return check(out, source_entries(blocks, title, subject, footer, compact, generator), docx_entries)
+
+
+def pdf_diff(out, blocks, title, footer=None, compact=False, generator=None):
+    return check(out, pdf_source_entries(blocks, title, footer, compact, generator), lambda path: pdf_entries(path, blocks))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check whether the guide DOCX/PDF match their Markdown source, and show what differs.')
+    parser.add_argument('src', nargs='?', type=Path)
+    parser.add_argument('outputs', nargs='*', type=Path, help='.docx/.pdf files to check (default: the checked-in guide)')
+    parser.add_argument('--compact', action='store_true', help='the outputs were built with --compact')
+    parser.add_argument('--keep-duplicates', action='store_true', help='the outputs were built with --keep-duplicates')
+    args = parser.parse_args()
+    start = time.perf_counter()
+    import build_first_use_docx
+    import convert_first_use_pdf
+    src = args.src or build_first_use_docx.SRC
+    try:
+        guide = load_blocks(src, args.keep_duplicates)
+    except ImageError as e:
+        # 1 means out of date.
+        parser.exit(2, f'{e}\n')
+    title = guide.title or src.stem
+    # Without a source the checked-in guide is checked with its own metadata.
+    subject, footer = (None, None) if args.src else (build_first_use_docx.SUBJECT, build_first_use_docx.FOOTER)
+    stale = 0
+    for out in args.outputs or [build_first_use_docx.OUT, build_first_use_docx.OUT.with_suffix('.pdf')]:
+        if out.suffix.lower() == '.pdf':
+            lines = pdf_diff(out, guide.blocks, title, footer, args.compact, convert_first_use_pdf.compiler_key()[:12])
+        else:
+            lines = docx_diff(out, guide.blocks, title, subject or guide.subtitle, footer, args.compact, build_first_use_docx.compiler_key()[:12])
+        stale += bool(lines)
+        print(f'{out}: out of date' if lines else f'{out}: up to date')
+        for line in lines:
+            print(line)
+    print(f'checked in {(time.perf_counter() - start) * 1000:.0f} ms')
+    sys.exit(1 if stale else 0)
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from urllib.parse import urlsplit
+from PIL import Image as PILImage
+import guide_ir as ir
+from guide_markdown import IMAGE, Section
+
+ROOT = Path(__file__).resolve().parents[1]
+CACHE_DIR = ROOT / '.cache' / 'images'
+DPI = 150
+PRINT_WIDTH = 6.5 * 72  # points between the 1in margins on Letter
+
+
+class ImageError(ValueError):
+    def __init__(self, message, source=None, line=None):
+        where = ':'.join(str(part) for part in (source, line) if part)
+        super().__init__(f'{where}: {message}' if where else message)
+        self.source, self.line = source, line
+
+
+@dataclass(frozen=True)
+class Processed:
+    path: Path
+    frame: str
+    width: int
+    height: int
+
+
+def frame_digest(img):
+    # The captured screen itself, before downscaling: re-encoded copies of a
+    # frame match, a frame with one pixel changed (a click highlight) does not.
+    digest = hashlib.sha256(f'{img.mode} {img.width}x{img.height}'.encode('ascii'))
+    digest.update(img.tobytes())
+    return digest.hexdigest()
+
+
+def pixel_digest(img):
+    # The samples ReportLab embeds for the image: grayscale stays one channel,
+    # anything else is written as RGB with alpha in a separate mask.
+    data = img.tobytes() if img.mode == 'L' else img.convert('RGB').tobytes()
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def process_image(src, digest, dpi=DPI, cache_dir=CACHE_DIR):
+    target = round(PRINT_WIDTH / 72 * dpi)
+    out = Path(cache_dir) / f'{digest}-{dpi}.png'
+    meta = out.with_suffix('.json')
+    if out.exists() and meta.exists():
+        info = json.loads(meta.read_text(encoding='utf-8'))
+        if 'frame' in info:
+            return Processed(out, info['frame'], info['width'], info['height'])
+    with PILImage.open(src) as img:
+        img.load()
+        frame = frame_digest(img)
+        if img.mode not in ('RGB', 'RGBA', 'L'):
+            img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+        if img.width > target:
+            img = img.resize((target, round(img.height * target / img.width)), PILImage.LANCZOS)
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        tmp = out.with_name(f'{out.stem}.{os.getpid()}.{threading.get_ident()}.tmp')
+        img.save(tmp, format='PNG')
+        tmp.replace(out)
+        width, height = img.size
+        pixels = pixel_digest(img)
+    meta.write_text(json.dumps({'frame': frame, 'width': width, 'height': height, 'pixels': pixels}), encoding='utf-8')
+    return Processed(out, frame, width, height)
+
+
+def image_line(source, path):
+    # Where in a section's Markdown an image is referenced, from 1.
+    for number, line in enumerate(source.splitlines(), 1):
+        match = IMAGE.match(line.strip())
+        if match and match.group(2) == path:
+            return number
+    return None
+
+
+def image_source(block, base_dir, section, first_line, src=None):
+    # The local file an Image block refers to. Anything else is reported
+    # with its line in the Markdown before any image is decoded.
+    line = image_line(section.source, block.path)
+    line = line and first_line + line - 1
+    if len(urlsplit(block.path).scheme) > 1:
+        raise ImageError(f'image is a URL, not a local file: {block.path}', src, line)
+    path = (Path(base_dir) / block.path).resolve()
+    if not path.is_file():
+        raise ImageError(f'image not found: {block.path}', src, line)
+    return path
+
+
+def prepare_sections(sections, base_dir, dpi=DPI, cache_dir=CACHE_DIR, workers=None, src=None, keep_duplicates=False):
+    # Decoding and resampling release the GIL, so a thread pool is enough.
+    # Image blocks come back pointing at the cached, downscaled copy with
+    # their print size set; unless keep_duplicates is set, a frame with the
+    # same pixels as the image right before it is dropped (and reported).
+    # src names the Markdown file in errors.
+    sources = {}
+    first_line = 1
+    for section in sections:
+        for block in section.blocks:
+            if isinstance(block, ir.Image):
+                sources.setdefault(image_source(block, base_dir, section, first_line, src))
+        first_line += section.source.count('\n') + 1
+    if not sources:
+        return sections
+    with ThreadPoolExecutor(workers) as pool:
+        digests = dict(zip(sources, pool.map(file_digest, sources)))
+        # Byte-identical captures are decoded once.
+        unique = {digest: path for path, digest in digests.items()}
+        results = dict(zip(unique, pool.map(lambda item: process_image(item[1], item[0], dpi, cache_dir), unique.items())))
+    processed = {path: results[digest] for path, digest in digests.items()}
+    previous = kept = None
+    prepared = []
+    for section in sections:
+        blocks = []
+        for block in section.blocks:
+            if isinstance(block, ir.Image):
+                image = processed[(Path(base_dir) / block.path).resolve()]
+                if not keep_duplicates and previous is not None and previous.frame == image.frame:
+                    print(f'{src or base_dir}: left out {block.path}, same screen as {kept}')
+                    continue
+                previous, kept = image, block.path
+                width = min(image.width / dpi * 72, PRINT_WIDTH)
+                block = ir.Image(str(image.path), block.alt, width, width * image.height / image.width)
+            blocks.append(block)
+        prepared.append(Section(section.source, blocks))
+    return prepared
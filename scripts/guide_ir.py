@@ -0,0 +1,98 @@
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+
+
+@dataclass(frozen=True)
+class Run:
+    # Formatting a run adds to its paragraph style; size is in points.
+    text: str
+    bold: bool = False
+    color: Optional[str] = None
+    size: Optional[float] = None
+
+
+@dataclass(frozen=True)
+class Title:
+    text: str
+
+
+@dataclass(frozen=True)
+class Subtitle:
+    text: str
+
+
+@dataclass(frozen=True)
+class Heading:
+    level: int
+    text: str
+
+
+@dataclass(frozen=True)
+class Text:
+    text: str
+    bold_prefix: Optional[str] = None
+    runs: Tuple[Run, ...] = ()
+
+
+@dataclass(frozen=True)
+class NumberItem:
+    text: str
+    index: int = 1
+    runs: Tuple[Run, ...] = ()
+
+
+@dataclass(frozen=True)
+class Bullet:
+    text: str
+    runs: Tuple[Run, ...] = ()
+
+
+@dataclass(frozen=True)
+class Note:
+    text: str
+    label: Optional[str] = None
+
+
+@dataclass(frozen=True)
+class Code:
+    text: str
+
+
+@dataclass(frozen=True)
+class Image:
+    # width/height are the print size in points, filled in by guide_images.
+    path: str
+    alt: str = ''
+    width: Optional[float] = None
+    height: Optional[float] = None
+
+
+@dataclass(frozen=True)
+class Table:
+    rows: List[List[str]]
+    widths: Optional[List[int]] = None
+
+    def column_widths(self, total=9360):
+        # Widths are in DXA (1/20 pt), as Word stores them.
+        if self.widths:
+            return self.widths
+        cols = max(len(row) for row in self.rows)
+        weights = [min(max(len(row[i]) if i < len(row) else 0 for row in self.rows), 40) + 6 for i in range(cols)]
+        widths = [total * w // sum(weights) for w in weights]
+        widths[-1] += total - sum(widths)
+        return widths
+
+
+@dataclass
+class Guide:
+    blocks: list = field(default_factory=list)
+    # Page footer label, when the source has one of its own.
+    footer: Optional[str] = None
+
+    @property
+    def title(self):
+        return next((block.text for block in self.blocks if isinstance(block, Title)), None)
+
+    @property
+    def subtitle(self):
+        return next((block.text for block in self.blocks if isinstance(block, Subtitle)), None)
@@ -0,0 +1,153 @@
+import re
+from collections import namedtuple
+from guide_ir import Bullet, Code, Guide, Heading, Image, Note, NumberItem, Subtitle, Table, Text, Title
+
+Section = namedtuple('Section', 'source blocks')
+
+LINK = re.compile(r'\[([^\]]+)\]\(([^)\s]+)\)')
+CODE = re.compile(r'`([^`]+)`')
+BOLD = re.compile(r'\*\*(.+?)\*\*')
+BOLD_PREFIX = re.compile(r'^\*\*(.+?)\*\*')
+NUMBER = re.compile(r'^\d+[.)]\s+')
+BULLET = re.compile(r'^[-*+]\s+')
+SUBTITLE = re.compile(r'^[*_]([^*_].*?)[*_]$')
+NOTE_LABEL = re.compile(r'^([^：\s]{1,8}：)')
+IMAGE = re.compile(r'^!\[([^\]]*)\]\(([^)\s]+)\)$')
+
+
+def link(match):
+    text, url = match.groups()
+    if url.startswith(('http://', 'https://')) and text != url:
+        return f'{text}（{url}）'
+    return text
+
+
+def inline(text):
+    text = CODE.sub(r'\1', LINK.sub(link, text.strip()))
+    prefix = BOLD_PREFIX.match(text)
+    return BOLD.sub(r'\1', text), prefix.group(1) if prefix else None
+
+
+def join_lines(lines):
+    out = ''
+    for line in lines:
+        hard_break = line.endswith('  ')
+        out += line.strip() + ('\n' if hard_break else ' ')
+    return out.strip()
+
+
+def split_row(line):
+    return [cell.strip() for cell in line.strip().strip('|').split('|')]
+
+
+def parse_blocks(lines):
+    blocks = []
+    para = []
+    item = None
+    subtitle_ok = False
+
+    def flush():
+        nonlocal para, item
+        if item:
+            kind, item_lines = item
+            text = inline(join_lines(item_lines))[0]
+            if kind is NumberItem:
+                # A screenshot between two steps does not restart the list.
+                previous = next((block for block in reversed(blocks) if not isinstance(block, Image)), None)
+                blocks.append(NumberItem(text, previous.index + 1 if isinstance(previous, NumberItem) else 1))
+            else:
+                blocks.append(Bullet(text))
+        elif para:
+            blocks.append(Text(*inline(join_lines(para))))
+        para, item = [], None
+
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        stripped = line.strip()
+        if stripped.startswith('```'):
+            flush()
+            code = []
+            i += 1
+            while i < len(lines) and not lines[i].strip().startswith('```'):
+                code.append(lines[i])
+                i += 1
+            blocks.append(Code('\n'.join(code)))
+        elif not stripped:
+            flush()
+        elif stripped.startswith('#'):
+            flush()
+            level = len(stripped) - len(stripped.lstrip('#'))
+            text = inline(stripped[level:])[0]
+            blocks.append(Title(text) if level == 1 else Heading(min(level - 1, 2), text))
+            subtitle_ok = level == 1
+            i += 1
+            continue
+        elif subtitle_ok and SUBTITLE.match(stripped) and not para:
+            blocks.append(Subtitle(inline(SUBTITLE.match(stripped).group(1))[0]))
+        elif stripped.startswith('>'):
+            flush()
+            quote = []
+            while i < len(lines) and lines[i].strip().startswith('>'):
+                quote.append(lines[i].strip()[1:])
+                i += 1
+            text = inline(join_lines(quote))[0]
+            label = NOTE_LABEL.match(text)
+            if label:
+                blocks.append(Note(text[label.end():], label.group(1)))
+            else:
+                blocks.append(Note(text))
+            subtitle_ok = False
+            continue
+        elif IMAGE.match(stripped):
+            flush()
+            alt, path = IMAGE.match(stripped).groups()
+            blocks.append(Image(path, alt))
+        elif stripped.startswith('|'):
+            flush()
+            rows = []
+            while i < len(lines) and lines[i].strip().startswith('|'):
+                cells = split_row(lines[i])
+                if not all(set(cell) <= set('-: ') for cell in cells):
+                    rows.append([inline(cell)[0] for cell in cells])
+                i += 1
+            blocks.append(Table(rows))
+            subtitle_ok = False
+            continue
+        elif NUMBER.match(stripped) or BULLET.match(stripped):
+            flush()
+            kind = NumberItem if NUMBER.match(stripped) else Bullet
+            marker = NUMBER if kind is NumberItem else BULLET
+            item = (kind, [marker.sub('', line.lstrip(), count=1)])
+        elif item and line[:1].isspace():
+            item[1].append(line)
+        else:
+            if item:
+                flush()
+            para.append(line)
+        subtitle_ok = subtitle_ok and not stripped
+        i += 1
+    flush()
+    return blocks
+
+
+def parse_sections(text):
+    # Each "## " heading starts a section; everything before the first one
+    # (title, subtitle, intro) is the preamble section.
+    sections = []
+    current = []
+    fenced = False
+    for line in text.splitlines():
+        if line.strip().startswith('```'):
+            fenced = not fenced
+        if not fenced and line.startswith('## ') and current:
+            sections.append(current)
+            current = []
+        current.append(line)
+    if current:
+        sections.append(current)
+    return [Section('\n'.join(lines), parse_blocks(lines)) for lines in sections]
+
+
+def parse_guide(text):
+    return Guide([block for section in parse_sections(text) for block in section.blocks])
@@ -0,0 +1,187 @@
+import hashlib
+import json
+import os
+import pickle
+import re
+import sys
+from fnmatch import fnmatch
+from pathlib import Path
+from weakref import WeakKeyDictionary
+import reportlab
+from reportlab import rl_config
+from reportlab.pdfbase.ttfonts import TTEncoding, TTFError, TTFont, TTFontFace
+
+ROOT = Path(__file__).resolve().parents[1]
+CACHE_DIR = ROOT / '.cache' / 'fonts'
+RESOLVED = CACHE_DIR / 'cjk-font.json'
+
+# TrueType-outline faces only: ReportLab cannot embed CFF fonts such as the
+# Noto Sans CJK .ttc/.otf files, so those are tried last and skipped if the
+# parse fails.
+CANDIDATES = (
+    'msyh.ttc', 'msyh.ttf', 'wqy-microhei.ttc', 'wqy-zenhei.ttc', 'NotoSansSC-Regular.ttf', 'NotoSansSC[wght].ttf',
+    'DroidSansFallbackFull.ttf', 'DroidSansFallback.ttf', 'simhei.ttf', 'simsun.ttc', 'Arial Unicode.ttf',
+    'NotoSansCJK-Regular.ttc', 'NotoSansCJKsc-Regular.otf',
+)
+SYSTEM_DIRS = (
+    r'C:\Windows\Fonts', '/usr/share/fonts', '/usr/local/share/fonts', '~/.local/share/fonts', '~/.fonts',
+    '/Library/Fonts', '/System/Library/Fonts', '~/Library/Fonts',
+)
+# Bold faces installed next to a regular one under an unrelated name; the
+# usual -Bold/bd spellings are tried for every font.
+BOLD_VARIANTS = {'msyh.ttc': 'msyhbd.ttc', 'msyh.ttf': 'msyhbd.ttf'}
+FONTCONFIG = ('/etc/fonts/fonts.conf', '/etc/fonts/conf.d')
+FC_DIR = re.compile(r'<dir(?:\s+prefix="(\w+)")?[^>]*>([^<]+)</dir>')
+CJK_PROBE = ord('中')
+
+
+class FontNotFoundError(LookupError):
+    pass
+
+
+def fontconfig_dirs():
+    files = []
+    for path in map(Path, FONTCONFIG):
+        if path.is_dir():
+            files += sorted(path.glob('*.conf'))
+        elif path.is_file():
+            files.append(path)
+    xdg = os.environ.get('XDG_DATA_HOME', '~/.local/share')
+    dirs = []
+    for path in files:
+        try:
+            text = path.read_text(encoding='utf-8', errors='ignore')
+        except OSError:
+            continue
+        for prefix, value in FC_DIR.findall(text):
+            dirs.append(os.path.join(xdg, value.strip()) if prefix == 'xdg' else value.strip())
+    return dirs
+
+
+def search_dirs():
+    configured = os.environ.get('SMARTPAGES_FONT_DIRS', '')
+    dirs = [d for d in configured.split(os.pathsep) if d] + fontconfig_dirs() + list(SYSTEM_DIRS)
+    seen = []
+    for d in dirs:
+        path = Path(os.path.expanduser(d))
+        if path not in seen and path.is_dir():
+            seen.append(path)
+    return seen
+
+
+def resolved_font(roots):
+    # The face find_cjk_font picked last time, if it searched the same roots
+    # and none of the directories it walked has changed since: adding,
+    # removing or renaming a font, or a directory, changes the mtime of the
+    # directory holding it.
+    try:
+        entry = json.loads(RESOLVED.read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        return None
+    if entry.get('roots') != roots or entry.get('candidates') != list(CANDIDATES):
+        return None
+    for path, mtime in entry['dirs'].items():
+        try:
+            if os.stat(path).st_mtime_ns != mtime:
+                return None
+        except OSError:
+            return None
+    path = Path(entry['path'])
+    return path if path.is_file() else None
+
+
+def find_cjk_font(dirs=None):
+    roots = [str(d) for d in (dirs if dirs is not None else search_dirs())]
+    path = resolved_font(roots)
+    if path is not None:
+        return path
+    found = {}
+    walked = {}
+    for root in roots:
+        for base, _, names in os.walk(root):
+            walked[base] = os.stat(base).st_mtime_ns
+            for name in names:
+                if name in CANDIDATES:
+                    found.setdefault(name, Path(base) / name)
+    for name in CANDIDATES:
+        if name in found:
+            try:
+                face = load_face(found[name])
+            except TTFError:
+                continue
+            if CJK_PROBE in face.charToGlyph:
+                CACHE_DIR.mkdir(parents=True, exist_ok=True)
+                tmp = RESOLVED.with_name(f'{RESOLVED.stem}.{os.getpid()}.tmp')
+                tmp.write_text(json.dumps({'roots': roots, 'candidates': list(CANDIDATES), 'dirs': walked, 'path': str(found[name])}), encoding='utf-8')
+                tmp.replace(RESOLVED)
+                return found[name]
+    raise FontNotFoundError('No CJK TrueType font found; set SMARTPAGES_PDF_FONT or SMARTPAGES_FONT_DIRS.')
+
+
+def find_bold_font(path):
+    # A bold face beside the regular one that covers the same script, or
+    # None; bold runs are then set in the regular face.
+    path = Path(path)
+    regular = load_face(path)
+    names = [BOLD_VARIANTS.get(path.name), path.name.replace('Regular', 'Bold'), f'{path.stem}-Bold{path.suffix}', f'{path.stem}bd{path.suffix}']
+    for name in names:
+        if not name or name == path.name or not (path.parent / name).is_file():
+            continue
+        try:
+            face = load_face(path.parent / name)
+        except TTFError:
+            continue
+        if CJK_PROBE in face.charToGlyph or CJK_PROBE not in regular.charToGlyph:
+            return path.parent / name
+    return None
+
+
+def cache_path(path, subfont_index):
+    stat = Path(path).stat()
+    key = f'{Path(path).resolve()}|{stat.st_mtime_ns}|{subfont_index}|{reportlab.Version}|{sys.version_info[:2]}'
+    return CACHE_DIR / f'{hashlib.sha256(key.encode("utf-8")).hexdigest()}.pickle'
+
+
+def unit_scale(units_per_em):
+    if units_per_em == 1000:
+        return lambda x: x
+    factor = 1000 / units_per_em
+    return lambda x: x * factor
+
+
+def load_face(path, subfont_index=0):
+    # The parsed metrics (cmap, widths, table directory) are pickled next to
+    # the other build caches; the raw font bytes are re-read from the file on
+    # every run because subsetting needs them and they are cheap to load.
+    cached = cache_path(path, subfont_index)
+    if cached.exists():
+        try:
+            state = pickle.loads(cached.read_bytes())
+        except Exception:
+            state = None
+        if state is not None:
+            face = TTFontFace.__new__(TTFontFace)
+            face.__dict__.update(state)
+            face._ttf_data = Path(path).read_bytes()
+            face._pdfScale = unit_scale(face.unitsPerEm)
+            return face
+    face = TTFontFace(str(path), subfontIndex=subfont_index)
+    state = {key: value for key, value in vars(face).items() if key not in ('_ttf_data', '_pdfScale')}
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = cached.with_name(f'{cached.stem}.{os.getpid()}.tmp')
+    tmp.write_bytes(pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL))
+    tmp.replace(cached)
+    return face
+
+
+def load_font(name, path, subfont_index=0):
+    # Same attributes TTFont.__init__ sets, but with a face that may come
+    # from the metrics cache.
+    font = TTFont.__new__(TTFont)
+    font.fontName = name
+    font.face = load_face(path, subfont_index)
+    font.encoding = TTEncoding()
+    font.state = WeakKeyDictionary()
+    font._asciiReadable = rl_config.ttfAsciiReadable
+    font.shapable = not any(fnmatch(name, pattern) for pattern in rl_config.unShapedFontGlob)
+    return font
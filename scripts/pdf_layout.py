@@ -0,0 +1,162 @@
+import hashlib
+import os
+import pickle
+import time
+from pathlib import Path
+from reportlab.lib.fonts import tt2ps
+from reportlab.lib.styles import ParagraphStyle
+from reportlab.pdfbase import pdfmetrics
+from reportlab.platypus import Paragraph
+
+ROOT = Path(__file__).resolve().parents[1]
+CACHE_DIR = ROOT / '.cache' / 'pdf-layout'
+FONT_DIGESTS = {}
+NO_FIT = 0x7fffffff
+
+
+def font_digest(name):
+    # Hash of the embedded font file, so swapping the CJK font (or a new
+    # version of it) invalidates every stored line break.
+    if name not in FONT_DIGESTS:
+        face = getattr(pdfmetrics.getFont(name), 'face', None)
+        data = getattr(face, '_ttf_data', None)
+        FONT_DIGESTS[name] = hashlib.sha256(data).hexdigest() if data else name
+    return FONT_DIGESTS[name]
+
+
+def family_digest(name):
+    # <b> runs are set in the family's bold face, which can be another file.
+    try:
+        bold = tt2ps(name, 1, 0)
+    except ValueError:
+        bold = name
+    return font_digest(name) if bold == name else font_digest(name) + font_digest(bold)
+
+
+def style_signature(style):
+    # The bullet is drawn in its own font, whose metrics move the text.
+    values = [family_digest(style.fontName), font_digest(style.bulletFontName)] + [repr(getattr(style, name)) for name in sorted(ParagraphStyle.defaults)]
+    return hashlib.sha256('\0'.join(values).encode('utf-8')).hexdigest()
+
+
+class LayoutCache:
+    # Line breaks and height of each wrapped paragraph, keyed by its markup,
+    # bullet, style (bullet font and size included), available width and font. Entries hold the pickled blPara so
+    # every hit gets its own copy: ReportLab's split mutates the words of
+    # the paragraph it splits.
+    def __init__(self, path):
+        self.path = Path(path)
+        try:
+            self.entries = pickle.loads(self.path.read_bytes())
+        except (OSError, pickle.UnpicklingError, EOFError):
+            self.entries = {}
+        self.used = {}
+        self.signatures = {}
+        self.hits = self.misses = 0
+        self.saved = 0.0
+
+    def key(self, paragraph, width):
+        style = paragraph.style
+        signature = self.signatures.get(id(style))
+        if signature is None or signature[0] is not style:
+            signature = self.signatures[id(style)] = (style, style_signature(style))
+        return paragraph.text, paragraph.bulletText, signature[1], round(width, 3)
+
+    def save(self):
+        # Only what this build used is kept, so the file tracks the document.
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(f'{self.path.stem}.{os.getpid()}.tmp')
+        tmp.write_bytes(pickle.dumps(self.used, protocol=pickle.HIGHEST_PROTOCOL))
+        tmp.replace(self.path)
+
+    def summary(self):
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0
+        return f'layout cache {self.hits}/{total} hits ({rate:.0f}%), ~{self.saved:.2f}s of wrapping saved'
+
+
+def cache_for(out):
+    return LayoutCache(CACHE_DIR / f'{hashlib.sha256(str(Path(out).resolve()).encode("utf-8")).hexdigest()}.pickle')
+
+
+class CachedParagraph(Paragraph):
+    # Paragraphs produced by split() have no text of their own and always
+    # wrap normally, as does everything while no cache is installed.
+    cache = None
+
+    def wrap(self, availWidth, availHeight):
+        cache = CachedParagraph.cache
+        if cache is None or self.text is None:
+            return super().wrap(availWidth, availHeight)
+        key = cache.key(self, availWidth)
+        if getattr(self, 'layout_key', None) == key and 'blPara' in self.__dict__:
+            # ReportLab re-wraps the same flowable (keepWithNext, table
+            # sizing); its blPara is still valid unless split() dropped it.
+            # That needs no cache, so it stays out of the totals.
+            return self.width, self.height
+        # A paragraph repeated in this build was counted the first time,
+        # whether it came from an earlier build or was wrapped in this one.
+        reused = key in cache.used
+        entry = cache.used.get(key) or cache.entries.get(key)
+        if entry is not None:
+            start = time.perf_counter()
+            data, height, seconds = entry
+            style = self.style
+            self.width = availWidth
+            self._wrapWidths = [
+                availWidth - (style.leftIndent + style.firstLineIndent) - style.rightIndent,
+                availWidth - style.leftIndent - style.rightIndent,
+            ]
+            self.blPara = pickle.loads(data)
+            self.height = height
+            self.layout_key = key
+            cache.used[key] = entry
+            if not reused:
+                cache.hits += 1
+                cache.saved += seconds - (time.perf_counter() - start)
+            return self.width, height
+        start = time.perf_counter()
+        width, height = super().wrap(availWidth, availHeight)
+        seconds = time.perf_counter() - start
+        cache.misses += 1
+        if height != NO_FIT:
+            cache.used[key] = (pickle.dumps(self.blPara, protocol=pickle.HIGHEST_PROTOCOL), height, seconds)
+            self.layout_key = key
+        return width, height
+
+
+def clone_fragment(frag, text):
+    # ABag.clone rebuilds the fragment through keyword arguments; copying its
+    # attribute dict is a third of the cost.
+    clone = frag.__class__.__new__(frag.__class__)
+    clone.__dict__.update(frag.__dict__)
+    clone.text = text
+    return clone
+
+
+class RunParagraph(CachedParagraph):
+    # A paragraph of formatted runs, given as (text, template fragments)
+    # parts. Its fragments are cloned from the templates when it is first
+    # laid out rather than when the story is built, so a long story holds
+    # runs, not fragments, and a layout cache hit never clones them.
+    parts = None
+
+    def __init__(self, text, style=None, bulletText=None, frags=None, parts=None, **kwargs):
+        super().__init__(text, style, bulletText, () if parts else frags, **kwargs)
+        self.parts = parts
+
+    @property
+    def frags(self):
+        if self.parts is not None:
+            frags = []
+            for text, (frag, line_break) in self.parts:
+                for i, line in enumerate(text.split('\n')):
+                    if i:
+                        frags.append(clone_fragment(line_break, line_break.text))
+                    frags.append(clone_fragment(frag, line or '\xa0'))
+            self._frags, self.parts = frags, None
+        return self._frags
+
+    @frags.setter
+    def frags(self, frags):
+        self._frags, self.parts = frags, None
@@ -0,0 +1,90 @@
+import cProfile
+import json
+import os
+import time
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+
+# Set SMARTPAGES_PROFILE to a report path (or pass --profile) to record
+# spans and counters; SMARTPAGES_CPROFILE adds a cProfile dump. While
+# disabled, span() hands back one shared null context and count() is a
+# single attribute test.
+REPORT = os.environ.get('SMARTPAGES_PROFILE')
+CPROFILE = os.environ.get('SMARTPAGES_CPROFILE')
+ENABLED = bool(REPORT)
+NULL = nullcontext()
+spans = {}
+counters = {}
+stack = []
+
+
+@contextmanager
+def timed_span(name):
+    stack.append(0.0)
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        children = stack.pop()
+        entry = spans.setdefault(name, [0, 0.0, 0.0])
+        entry[0] += 1
+        entry[1] += elapsed
+        entry[2] += elapsed - children
+        if stack:
+            stack[-1] += elapsed
+
+
+def span(name):
+    return timed_span(name) if ENABLED else NULL
+
+
+def count(name, n=1):
+    if ENABLED:
+        counters[name] = counters.get(name, 0) + n
+
+
+def counted(name, iterable):
+    if not ENABLED:
+        return iterable
+
+    def generate():
+        for item in iterable:
+            counters[name] = counters.get(name, 0) + 1
+            yield item
+    return generate()
+
+
+def report(script, seconds):
+    return {
+        'script': script,
+        'seconds': round(seconds, 6),
+        'spans': {
+            name: {'calls': calls, 'seconds': round(total, 6), 'self_seconds': round(own, 6)}
+            for name, (calls, total, own) in sorted(spans.items(), key=lambda item: -item[1][1])
+        },
+        'counters': dict(sorted(counters.items())),
+    }
+
+
+@contextmanager
+def session(script, report_path=None, cprofile_path=None):
+    global ENABLED
+    report_path = report_path or REPORT
+    cprofile_path = cprofile_path or CPROFILE
+    ENABLED = bool(report_path)
+    spans.clear()
+    counters.clear()
+    profiler = cProfile.Profile() if cprofile_path else None
+    start = time.perf_counter()
+    if profiler:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(cprofile_path)
+        if report_path:
+            data = report(script, time.perf_counter() - start)
+            Path(report_path).write_text(json.dumps(data, indent=2, ensure_ascii=False), encoding='utf-8')
@@ -0,0 +1,115 @@
+import ipaddress
+import re
+import unicodedata
+from urllib.parse import urlsplit
+
+# Mirrors workflow/schema.js; keep the two in step.
+VERSION = '1.0'
+ACTIONS = ('navigate', 'click', 'input', 'select', 'scroll', 'wait', 'assert')
+RISKS = ('low', 'medium', 'high')
+TARGET_REQUIRED_ACTIONS = ('click', 'input', 'select')
+TARGET_LOCATOR_HINTS = ('selector', 'rawSelector', 'role', 'name', 'text', 'tagName')
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+# Host code points the URL standard rejects (or percent-decodes).
+FORBIDDEN_HOST = re.compile(r'[\x00-\x20%<>\[\]^|\x7f]')
+NUMBER = re.compile(r'[0-9]+|0x[0-9a-f]*')
+
+
+class WorkflowError(ValueError):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+def is_canonical_punycode(label):
+    try:
+        text = label[4:].encode('ascii').decode('punycode')
+    except UnicodeError:
+        return False
+    return (text.encode('punycode').decode('ascii') == label[4:] and text
+            and unicodedata.normalize('NFKC', text).lower() == text
+            and not any(unicodedata.category(c)[0] in 'CZ' for c in text))
+
+
+def is_canonical_host(host):
+    # Whether a browser's URL parser keeps the host as written: it turns
+    # Unicode hosts into punycode, hosts ending in a number into dotted
+    # IPv4 and compresses IPv6 addresses, so the origin would not match.
+    if host.startswith('['):
+        try:
+            # No zone identifiers (fe80::1%25eth0) in URLs.
+            return '%' not in host and f'[{ipaddress.IPv6Address(host[1:-1])}]' == host
+        except ValueError:
+            return False
+    if not host.isascii() or FORBIDDEN_HOST.search(host):
+        return False
+    labels = host.split('.')
+    if labels[-1] == '' and len(labels) > 1:
+        labels.pop()
+    if NUMBER.fullmatch(labels[-1]):
+        try:
+            return str(ipaddress.IPv4Address(host)) == host
+        except ValueError:
+            return False
+    return all(is_canonical_punycode(label) for label in labels if label.startswith('xn--'))
+
+
+def is_exact_http_origin(origin):
+    if not isinstance(origin, str) or '*' in origin:
+        return False
+    try:
+        parts = urlsplit(origin)
+        port = parts.port
+    except ValueError:
+        return False
+    if parts.scheme not in DEFAULT_PORTS or not parts.hostname:
+        return False
+    host = f'[{parts.hostname}]' if ':' in parts.hostname else parts.hostname
+    if not is_canonical_host(host):
+        return False
+    suffix = f':{port}' if port is not None and port != DEFAULT_PORTS[parts.scheme] else ''
+    return f'{parts.scheme}://{host}{suffix}' == origin
+
+
+def is_positive_integer(value):
+    # JSON has one number type: 2.0 is an integer to Number.isInteger.
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and float(value).is_integer() and value > 0
+
+
+def non_empty(value):
+    return isinstance(value, str) and value.strip() != ''
+
+
+def validate_workflow(workflow):
+    if not isinstance(workflow, dict):
+        raise WorkflowError('INVALID_WORKFLOW', 'Workflow must be an object.')
+    if workflow.get('schemaVersion') != VERSION:
+        raise WorkflowError('UNSUPPORTED_SCHEMA', f'Workflow schemaVersion must be {VERSION}.')
+    if not non_empty(workflow.get('workflowId')):
+        raise WorkflowError('INVALID_WORKFLOW_ID', 'workflowId must be a non-empty string.')
+    if not is_positive_integer(workflow.get('workflowVersion')):
+        raise WorkflowError('INVALID_WORKFLOW_VERSION', 'workflowVersion must be a positive integer.')
+    origins = workflow.get('allowedOrigins')
+    if not isinstance(origins, list) or not origins or not all(map(is_exact_http_origin, origins)):
+        raise WorkflowError('INVALID_ALLOWED_ORIGINS', 'allowedOrigins must contain exact HTTP or HTTPS origins.')
+    if not isinstance(workflow.get('variables'), list):
+        raise WorkflowError('INVALID_VARIABLES', 'variables must be an array.')
+    steps = workflow.get('steps')
+    if not isinstance(steps, list) or not steps:
+        raise WorkflowError('INVALID_STEPS', 'steps must be a non-empty array.')
+    step_ids = set()
+    for step in steps:
+        if not isinstance(step, dict) or not non_empty(step.get('id')):
+            raise WorkflowError('INVALID_STEP_ID', 'Every step must have a non-empty string id.')
+        if step['id'] in step_ids:
+            raise WorkflowError('DUPLICATE_STEP_ID', f'Duplicate step id: {step["id"]}.')
+        step_ids.add(step['id'])
+        if step.get('action') not in ACTIONS:
+            raise WorkflowError('UNKNOWN_ACTION', f'Unknown action: {step.get("action")}.')
+        if step.get('risk') not in RISKS:
+            raise WorkflowError('INVALID_RISK', f'Invalid risk for step {step["id"]}.')
+        target = step.get('target')
+        has_target = non_empty(target) or (isinstance(target, dict) and any(non_empty(target.get(hint)) for hint in TARGET_LOCATOR_HINTS))
+        if step['action'] in TARGET_REQUIRED_ACTIONS and not has_target:
+            raise WorkflowError('MISSING_TARGET', f'Action {step["action"]} requires a target.')
+    return workflow
@@ -0,0 +1,49 @@
+import json
+import sys
+import unittest
+from pathlib import Path
+
+HERE = Path(__file__).resolve().parent
+sys.path.insert(0, str(HERE.parent / 'scripts'))
+
+from workflow_schema import WorkflowError, is_exact_http_origin, validate_workflow  # noqa: E402
+
+ORIGINS = json.loads((HERE / 'workflow-origins.json').read_text(encoding='utf-8'))
+
+
+def valid_workflow(**changes):
+    workflow = {
+        'schemaVersion': '1.0',
+        'workflowId': 'checkout',
+        'workflowVersion': 1,
+        'allowedOrigins': ['https://example.com'],
+        'variables': [],
+        'steps': [
+            {'id': 'open', 'action': 'navigate', 'risk': 'low', 'target': 'https://example.com/cart'},
+            {'id': 'buy', 'action': 'click', 'risk': 'high', 'target': '#buy'},
+        ],
+    }
+    workflow.update(changes)
+    return workflow
+
+
+class OriginTest(unittest.TestCase):
+    # The same origins tests/workflow-schema.test.js checks against
+    # workflow/schema.js.
+    def test_accepted(self):
+        for origin in ORIGINS['accepted']:
+            with self.subTest(origin=origin):
+                self.assertTrue(is_exact_http_origin(origin))
+                validate_workflow(valid_workflow(allowedOrigins=[origin]))
+
+    def test_rejected(self):
+        for origin in ORIGINS['rejected']:
+            with self.subTest(origin=origin):
+                self.assertFalse(is_exact_http_origin(origin))
+                with self.assertRaises(WorkflowError) as caught:
+                    validate_workflow(valid_workflow(allowedOrigins=[origin]))
+                self.assertEqual(caught.exception.code, 'INVALID_ALLOWED_ORIGINS')
+
+
+if __name__ == '__main__':
+    unittest.main()
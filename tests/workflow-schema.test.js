@@ -1,5 +1,6 @@
 const assert = require('node:assert/strict');
 const { loadBrowserScript } = require('./workflow-test-helpers');
+const origins = require('./workflow-origins.json');
 
 const api = loadBrowserScript('workflow/schema.js', 'SmartPagesWorkflowSchema');
 
@@ -65,6 +66,14 @@ for (const [workflow, code] of invalidCases) {
   assert.ok(result.message.length > 0);
 }
 
+// Shared with scripts/workflow_schema.py (tests/test_workflow_schema.py).
+for (const origin of origins.accepted) {
+  assert.equal(api.validateWorkflow({ ...validWorkflow(), allowedOrigins: [origin] }).ok, true, origin);
+}
+for (const origin of origins.rejected) {
+  assert.equal(api.validateWorkflow({ ...validWorkflow(), allowedOrigins: [origin] }).code, 'INVALID_ALLOWED_ORIGINS', origin);
+}
+
 assert.equal(api.isOriginAllowed('https://example.com/a', ['https://example.com']), true);
 assert.equal(api.isOriginAllowed('https://evil.example.com/a', ['https://example.com']), false);
 assert.equal(api.isOriginAllowed('not a url', ['https://example.com']), false);